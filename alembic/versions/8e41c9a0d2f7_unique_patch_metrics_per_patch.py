@@ -0,0 +1,32 @@
+"""Unique patch metrics per patch
+
+Revision ID: 8e41c9a0d2f7
+Revises: 3137b8f27851
+Create Date: 2026-10-18 18:02:11.408215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e41c9a0d2f7'
+down_revision: Union[str, None] = '3137b8f27851'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # metrics were saved once per collection, only the latest row of a patch is kept
+    op.execute(
+        'DELETE FROM patch_metrics pm USING patch_metrics newer '
+        'WHERE pm.patch_id = newer.patch_id AND pm.id < newer.id'
+    )
+    # a new database gets the index from create_all already
+    op.create_index('ix_patch_metrics_patch_id', 'patch_metrics', ['patch_id'], unique=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_patch_metrics_patch_id', table_name='patch_metrics')
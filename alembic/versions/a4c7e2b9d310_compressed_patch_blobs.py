@@ -0,0 +1,122 @@
+"""Compressed patch blobs
+
+Revision ID: a4c7e2b9d310
+Revises: e9a3c1f07b48
+Create Date: 2026-10-18 21:12:40.583104
+
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from domain.patch_codec import patch_codec, PATCH_DICT_SAMPLES
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c7e2b9d310'
+down_revision: Union[str, None] = 'e9a3c1f07b48'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MIGRATION_CHUNK_SIZE = int(os.getenv('MIGRATION_CHUNK_SIZE', '1000'))
+
+# (table, text column, nullable), every text moves to a `<column>_hash` reference of `patch_blobs`
+PATCH_COLUMNS = [
+    ('project_patches', 'patch', False),
+    ('project_commits', 'patch', False),
+    ('batches', 'last_patch', True),
+]
+
+patch_blobs = sa.table(
+    'patch_blobs',
+    sa.column('hash', sa.String), sa.column('dictionary_id', sa.Integer), sa.column('size', sa.Integer),
+    sa.column('data', sa.LargeBinary),
+)
+patch_dictionaries = sa.table('patch_dictionaries', sa.column('id', sa.Integer), sa.column('data', sa.LargeBinary))
+
+
+def upgrade() -> None:
+    # the blob and dictionary tables, and the hash columns of a new database, come from create_all
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    columns = [
+        (table, column, nullable) for table, column, nullable in PATCH_COLUMNS
+        if column in {info['name'] for info in inspector.get_columns(table)}
+    ]
+    if len(columns) == 0:
+        return
+
+    train_dictionary(bind)
+    for table, column, nullable in columns:
+        op.add_column(table, sa.Column(f'{column}_hash', sa.String(64), nullable=True))
+        move_texts(bind, table, column)
+        op.drop_column(table, column)
+        if not nullable:
+            op.alter_column(table, f'{column}_hash', nullable=False)
+        op.create_foreign_key(f'{table}_{column}_hash_fkey', table, 'patch_blobs', [f'{column}_hash'], ['hash'])
+
+
+def train_dictionary(bind):
+    latest = bind.execute(sa.text('SELECT id, data FROM patch_dictionaries ORDER BY id DESC LIMIT 1')).one_or_none()
+    if latest is not None:
+        patch_codec.add_dictionary(latest.id, latest.data)
+        return
+    samples = [
+        row.patch.encode('utf-8', 'surrogatepass')
+        for row in bind.execute(sa.text(
+            'SELECT patch FROM (SELECT id, patch FROM project_patches ORDER BY id DESC LIMIT :limit) p'
+        ), {'limit': PATCH_DICT_SAMPLES})
+    ]
+    data = patch_codec.train(samples) if len(samples) >= PATCH_DICT_SAMPLES else None
+    if data is None:
+        patch_codec.initialized = True
+        return
+    dictionary_id = bind.execute(
+        insert(patch_dictionaries).values(data=data).returning(patch_dictionaries.c.id)
+    ).scalar()
+    patch_codec.add_dictionary(dictionary_id, data)
+
+
+def move_texts(bind, table: str, column: str):
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.text(
+            f'SELECT id, {column} AS text FROM {table} WHERE id > :last_id AND {column} IS NOT NULL '
+            f'ORDER BY id LIMIT :limit'
+        ), {'last_id': last_id, 'limit': MIGRATION_CHUNK_SIZE}).all()
+        if len(rows) == 0:
+            break
+        blobs = {}
+        references = []
+        for row in rows:
+            blob_hash, dictionary_id, size, data = patch_codec.compress(row.text)
+            blobs[blob_hash] = {'hash': blob_hash, 'dictionary_id': dictionary_id, 'size': size, 'data': data}
+            references.append({'row_id': row.id, 'blob_hash': blob_hash})
+        bind.execute(insert(patch_blobs).values(list(blobs.values())).on_conflict_do_nothing(index_elements=['hash']))
+        bind.execute(sa.text(f'UPDATE {table} SET {column}_hash = :blob_hash WHERE id = :row_id'), references)
+        last_id = rows[-1].id
+        print(f'{table}.{column}: moved up to id {last_id}')
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    for table, column, nullable in PATCH_COLUMNS:
+        op.add_column(table, sa.Column(column, sa.Text(), nullable=True))
+        last_id = 0
+        while True:
+            rows = bind.execute(sa.text(
+                f'SELECT t.id, b.dictionary_id, b.data FROM {table} t JOIN patch_blobs b ON b.hash = t.{column}_hash '
+                f'WHERE t.id > :last_id ORDER BY t.id LIMIT :limit'
+            ), {'last_id': last_id, 'limit': MIGRATION_CHUNK_SIZE}).all()
+            if len(rows) == 0:
+                break
+            bind.execute(sa.text(f'UPDATE {table} SET {column} = :text WHERE id = :row_id'), [
+                {'row_id': row.id, 'text': patch_codec.decompress(row.dictionary_id, row.data)} for row in rows
+            ])
+            last_id = rows[-1].id
+        if not nullable:
+            op.alter_column(table, column, nullable=False)
+        op.drop_column(table, f'{column}_hash')
+    # patch_blobs and patch_dictionaries come from create_all and are referenced by later tables, they are kept
@@ -0,0 +1,28 @@
+"""Batch metrics log index
+
+Revision ID: b5d2e7f4a913
+Revises: 8e41c9a0d2f7
+Create Date: 2026-10-18 18:41:37.902114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5d2e7f4a913'
+down_revision: Union[str, None] = '8e41c9a0d2f7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # the time rollup reads metrics of a batch in time order, get_last_metrics reads the latest one
+    op.create_index('ix_batch_code_metrics_log_batch_entity_created', 'batch_code_metrics_log',
+                    ['batch_id', 'entity', 'is_unique', 'created_at'], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_batch_code_metrics_log_batch_entity_created', table_name='batch_code_metrics_log')
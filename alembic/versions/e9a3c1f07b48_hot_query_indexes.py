@@ -0,0 +1,73 @@
+"""Hot query indexes
+
+Revision ID: e9a3c1f07b48
+Revises: b5d2e7f4a913
+Create Date: 2026-10-18 19:34:08.115932
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e9a3c1f07b48'
+down_revision: Union[str, None] = 'b5d2e7f4a913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # a commit could be saved more than once before, the links of every copy move to the oldest one,
+    # which is the only one kept
+    op.execute(
+        'UPDATE batch_project_commits bpc SET commit_id = kept.id '
+        'FROM project_commits copy '
+        'JOIN (SELECT branch_commit, min(id) AS id FROM project_commits GROUP BY branch_commit) kept '
+        'ON kept.branch_commit = copy.branch_commit '
+        'WHERE bpc.commit_id = copy.id AND copy.id <> kept.id'
+    )
+    # a batch linked to several copies now links the kept commit more than once
+    op.execute(
+        'DELETE FROM batch_project_commits bpc USING batch_project_commits older '
+        'WHERE bpc.batch_id = older.batch_id AND bpc.commit_id = older.commit_id AND bpc.id > older.id'
+    )
+    op.execute(
+        'DELETE FROM project_commits pc USING project_commits older '
+        'WHERE pc.branch_commit = older.branch_commit AND pc.id > older.id'
+    )
+    # a new database gets these indexes from create_all already
+    op.create_index('ix_project_commits_branch_commit', 'project_commits', ['branch_commit'],
+                    unique=True, if_not_exists=True)
+    op.create_index('ix_worklogs_project_not_saved', 'worklogs', ['project_id'],
+                    postgresql_where=sa.text('NOT externally_saved'), if_not_exists=True)
+    op.create_index('ix_batches_project_active', 'batches', ['project_id'],
+                    postgresql_where=sa.text('is_active'), if_not_exists=True)
+    op.create_index('ix_batches_project_not_processed', 'batches', ['project_id'],
+                    postgresql_where=sa.text('NOT is_processed'), if_not_exists=True)
+    op.create_index('ix_batch_worklogs_batch', 'batch_worklogs', ['batch_id'],
+                    postgresql_include=['worklog_id'], if_not_exists=True)
+    op.create_index('ix_batch_project_patches_batch_created', 'batch_project_patches', ['batch_id', 'created_at'],
+                    postgresql_include=['patch_id'], if_not_exists=True)
+    op.create_index('ix_batch_project_patches_batch_row', 'batch_project_patches', ['batch_id', 'id'],
+                    postgresql_include=['patch_id'], if_not_exists=True)
+    op.create_index('ix_batch_project_commits_batch_row', 'batch_project_commits', ['batch_id', 'id'],
+                    postgresql_include=['commit_id'], if_not_exists=True)
+    op.create_index('ix_openai_assistant_threads_session', 'openai_assistant_threads', ['session_id'],
+                    if_not_exists=True)
+    op.create_index('ix_openai_assistant_threads_open', 'openai_assistant_threads', ['project_id', 'assistant_type'],
+                    postgresql_where=sa.text('closed_at IS NULL'), if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_openai_assistant_threads_open', table_name='openai_assistant_threads')
+    op.drop_index('ix_openai_assistant_threads_session', table_name='openai_assistant_threads')
+    op.drop_index('ix_batch_project_commits_batch_row', table_name='batch_project_commits')
+    op.drop_index('ix_batch_project_patches_batch_row', table_name='batch_project_patches')
+    op.drop_index('ix_batch_project_patches_batch_created', table_name='batch_project_patches')
+    op.drop_index('ix_batch_worklogs_batch', table_name='batch_worklogs')
+    op.drop_index('ix_batches_project_not_processed', table_name='batches')
+    op.drop_index('ix_batches_project_active', table_name='batches')
+    op.drop_index('ix_worklogs_project_not_saved', table_name='worklogs')
+    op.drop_index('ix_project_commits_branch_commit', table_name='project_commits')
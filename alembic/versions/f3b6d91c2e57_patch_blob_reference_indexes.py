@@ -0,0 +1,33 @@
+"""Patch blob reference indexes
+
+Revision ID: f3b6d91c2e57
+Revises: a4c7e2b9d310
+Create Date: 2026-10-18 23:41:17.204381
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b6d91c2e57'
+down_revision: Union[str, None] = 'a4c7e2b9d310'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # the cleanup of unreferenced blobs and the foreign key checks of its deletes look the references up by hash,
+    # a new database gets these indexes from create_all already
+    op.create_index('ix_project_patches_patch_hash', 'project_patches', ['patch_hash'], if_not_exists=True)
+    op.create_index('ix_project_commits_patch_hash', 'project_commits', ['patch_hash'], if_not_exists=True)
+    op.create_index('ix_batches_last_patch_hash', 'batches', ['last_patch_hash'],
+                    postgresql_where=sa.text('last_patch_hash IS NOT NULL'), if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_batches_last_patch_hash', table_name='batches')
+    op.drop_index('ix_project_commits_patch_hash', table_name='project_commits')
+    op.drop_index('ix_project_patches_patch_hash', table_name='project_patches')
@@ -1,18 +1,28 @@
 import asyncio
 import datetime
-import difflib
 import os
 from typing import Dict, List
 
+from api.code_watch.tree_index import WorkingTreeIndex
+from api.project_runner import ProjectRunner
+from api.git_workers.pool import worker_pool
 from domain.common_db import get_projects, save_diff_to_db
 from domain.db.batches import Batches
+from domain.db.unit_of_work import transaction
 from domain.diff import Patch
+from domain.diff_engine import unified_diff
+from domain.patch_cache import parse_patch
 from domain.project import ProjectContext
 
+# `events` uses inotify when the platform supports it, `polling` checks every project once a minute
+DIFF_WATCH_MODE = os.getenv('DIFF_WATCH_MODE', 'events')
+
 
 class DiffWatcher:
     def __init__(self):
         self.contexts: Dict[int, ProjectContext] = {}
+        self.git_workers = worker_pool
+        self.runner = ProjectRunner('diff-watcher')
 
     def load_file_content(self, file_path):
         if not os.path.exists(file_path):
@@ -21,7 +31,7 @@ class DiffWatcher:
             return file.read()
 
     def texts_diff(self, text1, text2, name1, name2):
-        diff = difflib.unified_diff(
+        diff = unified_diff(
             text1.splitlines(keepends=True),
             text2.splitlines(keepends=True),
             fromfile=name1,
@@ -47,8 +57,8 @@ class DiffWatcher:
         return lines
 
     def generate_intermediate_patch(self, first_diff_content, current_diff_content, repo_path, extensions: List[str]):
-        first_diffs = Patch(first_diff_content.splitlines(keepends=True)).get_diffs()
-        current_patch = Patch(current_diff_content.splitlines(keepends=True))
+        first_diffs = parse_patch(first_diff_content).get_diffs()
+        current_patch = parse_patch(current_diff_content)
         last_diffs = current_patch.get_diffs()
 
         intermediate_patches = []
@@ -63,37 +73,23 @@ class DiffWatcher:
 
         for file_path in filenames:
             abs_file_path = os.path.join(repo_path, file_path)
-            initial_content = []
-            current_content = []
-            reversed_content = []
-            initial_content = []
-            file_content = []
-            first_file = []
-
-            if file_path in first_diffs and first_diffs[file_path].is_deleted:
-                initial_content = []
-            else:
-                file_content = self.load_file_content(abs_file_path).splitlines(keepends=True)  # nice
-                if file_path in last_diffs:
-                    reversed_content = last_diffs[file_path].revert(file_content)
-                    if file_path in first_diffs:
-                        initial_content = first_diffs[file_path].apply(reversed_content)  # bad
-
-            first_file = (
-                initial_content if len(initial_content) > 0
-                else reversed_content
-                if len(reversed_content) > 0
-                else file_content
-            )
+            original_content = self.get_original_content(repo_path, file_path, first_diffs, last_diffs)
 
-            if file_path not in first_diffs and file_path in last_diffs and len(reversed_content) == 0:
-                first_file = []
-
-            if file_path in last_diffs:
-                if not last_diffs[file_path].is_deleted:
-                    current_content = self.load_file_content(abs_file_path).splitlines(keepends=True)  # nice
+            if original_content is not None:
+                if file_path in first_diffs and first_diffs[file_path].is_deleted:
+                    first_file = []
+                elif file_path in first_diffs:
+                    first_file = first_diffs[file_path].apply(original_content)
                 else:
+                    first_file = original_content
+
+                if file_path in last_diffs and last_diffs[file_path].is_deleted:
                     current_content = []
+                else:
+                    current_content = self.load_file_content(abs_file_path).splitlines(keepends=True)
+            else:
+                first_file, current_content = self.revert_to_first_content(abs_file_path, file_path,
+                                                                           first_diffs, last_diffs)
 
             if first_file == current_content:
                 continue
@@ -101,7 +97,7 @@ class DiffWatcher:
             self.fix_lineends(first_file)
             self.fix_lineends(current_content)
 
-            intermediate_patch = difflib.unified_diff(
+            intermediate_patch = unified_diff(
                 first_file,  # .splitlines(keepends=True),
                 current_content,  # .splitlines(keepends=True),
                 fromfile=file_path,
@@ -116,59 +112,130 @@ class DiffWatcher:
         return '\n'.join(intermediate_patches), len(intermediate_patches), \
             current_patch.get_files_with_extensions_only(extensions)
 
-    # Function to get the current diff of the repository
-    def get_current_diff(self, repo, extensions: List[str]):
-        diff = self.get_tracked_files_diff(repo)
-        new_files_patches = self.get_untracked_files_diff(extensions, repo)
-        if new_files_patches != '':
-            diff += f'\n{new_files_patches}'
+    def get_original_content(self, repo_path, file_path, first_diffs, last_diffs) -> List[str] | None:
+        # the first diff applies only to the blob it was taken against, the blob of the last diff is a later
+        # commit's one once something was committed in between
+        diffs = first_diffs if file_path in first_diffs else last_diffs
+        if file_path not in diffs or diffs[file_path].original_blob is None:
+            return None
+        content = self.git_workers.read_blob(repo_path, diffs[file_path].original_blob)
+        if content is None:
+            return None
+        return content.decode('utf-8', errors='replace').splitlines(keepends=True)
+
+    def revert_to_first_content(self, abs_file_path, file_path, first_diffs, last_diffs):
+        initial_content = []
+        current_content = []
+        reversed_content = []
+        file_content = []
+
+        if file_path not in first_diffs or not first_diffs[file_path].is_deleted:
+            file_content = self.load_file_content(abs_file_path).splitlines(keepends=True)
+            if file_path in last_diffs:
+                reversed_content = last_diffs[file_path].revert(file_content)
+                if file_path in first_diffs:
+                    initial_content = first_diffs[file_path].apply(reversed_content)
+
+        first_file = (
+            initial_content if len(initial_content) > 0
+            else reversed_content
+            if len(reversed_content) > 0
+            else file_content
+        )
 
-        if not diff.endswith('\n'):
-            diff += '\n'
+        if file_path not in first_diffs and file_path in last_diffs and len(reversed_content) == 0:
+            first_file = []
 
-        return diff
+        if file_path in last_diffs:
+            if last_diffs[file_path].is_deleted:
+                current_content = []
+            elif file_path in first_diffs and first_diffs[file_path].is_deleted:
+                current_content = self.load_file_content(abs_file_path).splitlines(keepends=True)
+            else:
+                current_content = list(file_content)
 
-    def get_tracked_files_diff(self, repo):
-        return repo.git.diff('HEAD', full_index=True, unified=3)
+        return first_file, current_content
 
-    def get_untracked_files_diff(self, extensions, repo):
-        untracked_files = repo.untracked_files
-        filenames = set[str]()
-        for untracked_file in untracked_files:
-            for extension in extensions:
-                if untracked_file.endswith(extension):
-                    filenames.add(untracked_file)
-        new_files_patches = ""
+    # Function to get the current diff of the repository
+    def get_current_diff(self, context: ProjectContext):
+        index = context.tree_index
+        if index is None:
+            index = WorkingTreeIndex(context.repo, context.extensions)
+            context.tree_index = index
+
+        if index.needs_full_scan():
+            tracked_diff = self.get_tracked_files_diff(context.repo)
+            untracked_files = context.repo.untracked_files
+            index.scan(context.repo.git.ls_files().splitlines(), untracked_files)
+            index.set_tracked_patches(Patch(tracked_diff).get_file_texts())
+            index.set_untracked_patches(self.get_untracked_files_patches(list(index.untracked.keys()), context.repo))
+        else:
+            changed_tracked, changed_untracked = index.changed_files()
+            if len(changed_tracked) > 0:
+                tracked_diff = self.get_tracked_files_diff(context.repo, changed_tracked)
+                index.set_tracked_patches(Patch(tracked_diff).get_file_texts(), changed_tracked)
+            if len(changed_untracked) > 0:
+                index.set_untracked_patches(self.get_untracked_files_patches(changed_untracked, context.repo),
+                                            changed_untracked)
+
+        return index.to_string()
+
+    def get_tracked_files_diff(self, repo, paths: List[str] | None = None):
+        if paths is None:
+            return repo.git.diff('HEAD', full_index=True, unified=3)
+        return repo.git.diff('HEAD', '--', *paths, full_index=True, unified=3)
+
+    def get_untracked_files_patches(self, filenames: List[str], repo) -> Dict[str, str]:
+        patches = {}
         for filename in filenames:
-            a_name = "a/dev/null"
-            b_name = f'b/{filename}'
-
-            file_content = self.load_file_content(f'{repo.working_tree_dir}/{filename}')
-            lines = file_content.strip('\r\n\t ').splitlines(keepends=True)
-            if len(lines) > 0:
-                new_files_patches += f'diff --git {a_name} {b_name}\n'
-                new_files_patches += f"--- {a_name}\n+++ {b_name}\n"
-                new_files_patches += f"@@ -0,0 +0,{len(lines)} @@\n"
-                for line in lines:
-                    new_files_patches += f'+{line}'.strip("\r\n") + '\n'
-        return new_files_patches
-
-    def start_once(self):
+            file_patch = self.get_untracked_file_diff(filename, repo)
+            if file_patch != '':
+                patches[filename] = file_patch
+        return patches
+
+    def get_untracked_file_diff(self, filename: str, repo) -> str:
+        a_name = "a/dev/null"
+        b_name = f'b/{filename}'
+
+        file_content = self.load_file_content(f'{repo.working_tree_dir}/{filename}')
+        lines = file_content.strip('\r\n\t ').splitlines(keepends=True)
+        if len(lines) == 0:
+            return ''
+        file_patch = [
+            f'diff --git {a_name} {b_name}\n',
+            f"--- {a_name}\n+++ {b_name}\n",
+            f"@@ -0,0 +0,{len(lines)} @@\n",
+        ]
+        for line in lines:
+            file_patch.append(f'+{line}'.strip("\r\n") + '\n')
+        return ''.join(file_patch)
+
+    async def start_once(self):
+        await self.run_projects(self.update_contexts())
+
+    async def run_projects(self, contexts: List[ProjectContext]):
+        await self.runner.run(contexts, self.run_project)
+
+    def update_contexts(self) -> List[ProjectContext]:
         projects = get_projects()
+        contexts = []
         for project in projects:
             if project.id not in self.contexts:
                 self.contexts[project.id] = ProjectContext(project)
-            context = self.contexts[project.id]
+            contexts.append(self.contexts[project.id])
+        return contexts
 
-            if context.repo.head.commit.hexsha != context.current_commit:
-                context.current_branch = context.repo.active_branch.name
-                context.current_commit = context.repo.head.commit.hexsha
-                context.last_diff = None
-            self.run(context)
+    def run_project(self, context: ProjectContext):
+        if context.repo.head.commit.hexsha != context.current_commit:
+            context.current_branch = context.repo.active_branch.name
+            context.current_commit = context.repo.head.commit.hexsha
+            context.last_diff = None
+            context.current_diff = None
+        self.run(context)
 
     async def start(self):
         while True:
-            self.start_once()
+            await self.start_once()
             await asyncio.sleep(60 - datetime.datetime.now().second)
             # await asyncio.sleep(2)
 
@@ -180,16 +247,19 @@ class DiffWatcher:
                 print(
                     f'Initial diff is read from database for {context.project.name}/{context.current_branch}/{context.current_commit}')
             else:
-                context.last_diff = self.get_current_diff(context.repo, context.extensions)
+                context.last_diff = self.get_current_diff(context)
                 print(
                     f'Initial diff is read from filesystem for {context.project.name}/{context.current_branch}/{context.current_commit}')
                 return
 
-        current_diff = self.get_current_diff(context.repo, context.extensions)
-        current_diff = Patch(current_diff).get_files_with_extensions_only(context.extensions).to_string()
+        whole_diff = self.get_current_diff(context)
+        if whole_diff is context.current_diff:
+            return
+        current_diff = parse_patch(whole_diff).get_files_with_extensions_only(context.extensions).to_string()
 
         if current_diff.strip("\r\n\t ") == context.last_diff.strip("\r\n\t "):
             # print("No difference found")
+            context.current_diff = whole_diff
             return
         print(f"{context.project.name}: diffs are not equal")
         intermediate_patch, size, full_current_diff = self.generate_intermediate_patch(context.last_diff,
@@ -199,11 +269,13 @@ class DiffWatcher:
 
         if intermediate_patch != "":
             print(f"{context.project.name}: diff is built ({size} lines) and being saved")
-            save_diff_to_db(context, intermediate_patch, "")
-            patch = Patch(intermediate_patch)
+            patch = parse_patch(intermediate_patch)
+            with transaction():
+                save_diff_to_db(context, intermediate_patch, "", patch)
+                Batches().update_current_patch(context.project.id, full_current_diff.to_string(),
+                                               context.current_branch)
             print(f"Metrics of saved diff: {patch.get_metrics()}")
             context.last_diff = current_diff
-            Batches().update_current_patch(context.project.id, full_current_diff.to_string(), context.current_branch)
         else:
             print(f"{context.project.name}: diff is empty, looks like it contains files out of our filters")
 
@@ -214,3 +286,6 @@ class DiffWatcher:
 
             if context.last_diff is None:
                 context.last_diff = current_diff
+
+        # the diff counts as handled only once it is saved, a failed save is retried on the next tick
+        context.current_diff = whole_diff
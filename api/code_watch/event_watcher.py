@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+from typing import Dict, Set, List
+
+from api.code_watch.diff_watcher import DiffWatcher
+from api.code_watch.inotify import Inotify, InotifyEvent, IN_ISDIR, IN_Q_OVERFLOW, IN_IGNORED
+from domain.project import ProjectContext
+
+GIT_STATE_FILES = {'index', 'HEAD'}
+
+
+class DiffEventWatcher:
+    """Runs DiffWatcher for a project only after inotify reported changes in its working tree.
+
+    Events are debounced per project: a project is processed `debounce` seconds after its last event,
+    but not later than `max_delay` seconds after the first one.
+    """
+
+    def __init__(self, diff_watcher: DiffWatcher, debounce: float = 0.5, max_delay: float = 5,
+                 refresh_interval: int = 300):
+        self.diff_watcher = diff_watcher
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.refresh_interval = refresh_interval
+
+        self.inotify: Inotify | None = None
+        self.watches: Dict[int, Set[int]] = {}  # wd: project ids
+        self.project_watches: Dict[int, Dict[str, int]] = {}  # project id: {directory: wd}
+        self.git_dirs: Dict[int, str] = {}  # project id: git dir
+
+        self.first_event_at: Dict[int, float] = {}  # project id: monotonic time of its first pending event
+        self.flush_handles: Dict[int, asyncio.TimerHandle] = {}  # project id: scheduled flush
+        self.refresh_task: asyncio.Task | None = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.inotify is not None
+
+    def start(self) -> bool:
+        if not Inotify.is_available():
+            print('inotify is not available, diff watcher falls back to polling')
+            return False
+        self.inotify = Inotify()
+        asyncio.get_event_loop().add_reader(self.inotify.fileno(), self.on_events)
+        self.refresh_task = asyncio.ensure_future(self.refresh_periodically())
+        print('diff watcher is driven by filesystem events')
+        return True
+
+    def stop(self):
+        if self.inotify is None:
+            return
+        asyncio.get_event_loop().remove_reader(self.inotify.fileno())
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        for handle in self.flush_handles.values():
+            handle.cancel()
+        self.flush_handles = {}
+        self.first_event_at = {}
+        self.inotify.close()
+        self.inotify = None
+        self.watches = {}
+        self.project_watches = {}
+
+    async def refresh_periodically(self):
+        while self.inotify is not None:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self):
+        contexts = self.diff_watcher.update_contexts()
+        active = {context.project.id for context in contexts}
+        for project_id in list(self.project_watches.keys()):
+            if project_id not in active:
+                self.sync_watches(project_id, [])
+        await self.run_projects(contexts)
+
+    def on_events(self):
+        events = self.inotify.read_events()
+        changed: Set[int] = set()
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                changed.update(self.project_watches.keys())
+                continue
+            if event.mask & IN_IGNORED:
+                self.forget_watch(event.wd)
+                continue
+            for project_id in self.watches.get(event.wd, set()):
+                if self.is_relevant(project_id, event):
+                    changed.add(project_id)
+
+        now = time.monotonic()
+        for project_id in changed:
+            first_event_at = self.first_event_at.setdefault(project_id, now)
+            self.schedule_flush(project_id, max(0.0, min(self.debounce, first_event_at + self.max_delay - now)))
+
+    def schedule_flush(self, project_id: int, delay: float):
+        handle = self.flush_handles.get(project_id)
+        if handle is not None:
+            handle.cancel()
+        self.flush_handles[project_id] = asyncio.get_event_loop().call_later(delay, self.flush, project_id)
+
+    def is_relevant(self, project_id: int, event: InotifyEvent) -> bool:
+        if event.name == '' or event.mask & IN_ISDIR:
+            return True
+        if self.project_watches[project_id].get(self.git_dirs[project_id]) == event.wd:
+            return event.name in GIT_STATE_FILES
+        context = self.diff_watcher.contexts.get(project_id)
+        if context is None:
+            return False
+        for extension in context.extensions:
+            if event.name.endswith(extension):
+                return True
+        return False
+
+    def flush(self, project_id: int):
+        self.flush_handles.pop(project_id, None)
+        self.first_event_at.pop(project_id, None)
+        if self.diff_watcher.runner.is_running(project_id):
+            # retried after the current run, otherwise its changes would be lost
+            self.schedule_flush(project_id, self.debounce)
+            return
+        context = self.diff_watcher.contexts.get(project_id)
+        if context is not None:
+            asyncio.ensure_future(self.run_projects([context]))
+
+    async def run_projects(self, contexts: List[ProjectContext]):
+        await self.diff_watcher.run_projects(contexts)
+        if self.inotify is None:
+            return
+        for context in contexts:
+            self.sync_project_watches(context)
+
+    def sync_project_watches(self, context: ProjectContext):
+        directories = []
+        if context.tree_index is not None:
+            directories.extend(context.tree_index.directories.keys())
+        self.git_dirs[context.project.id] = context.repo.git_dir
+        directories.append(context.repo.git_dir)
+        self.sync_watches(context.project.id, directories)
+
+    def sync_watches(self, project_id: int, directories: List[str]):
+        current = self.project_watches.setdefault(project_id, {})
+        wanted = set(directories)
+
+        for directory in list(current.keys()):
+            if directory in wanted:
+                continue
+            wd = current.pop(directory)
+            projects = self.watches.get(wd, set())
+            projects.discard(project_id)
+            if len(projects) == 0:
+                self.watches.pop(wd, None)
+                self.inotify.remove_watch(wd)
+
+        for directory in wanted:
+            if directory in current or not os.path.isdir(directory):
+                continue
+            try:
+                wd = self.inotify.add_watch(directory)
+            except OSError as e:
+                print(f'unable to watch {directory}: {e}')
+                continue
+            current[directory] = wd
+            self.watches.setdefault(wd, set()).add(project_id)
+
+        if len(current) == 0:
+            self.project_watches.pop(project_id, None)
+
+    def forget_watch(self, wd: int):
+        for project_id in self.watches.pop(wd, set()):
+            watches = self.project_watches.get(project_id, {})
+            for directory, directory_wd in list(watches.items()):
+                if directory_wd == wd:
+                    watches.pop(directory)
@@ -0,0 +1,117 @@
+import os
+from typing import Dict, List, Tuple
+
+import git
+
+Fingerprint = Tuple[int, int, int]  # mtime_ns, size, inode
+
+
+def stat_fingerprint(path: str) -> Fingerprint | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class WorkingTreeIndex:
+    """Stat fingerprints of the watched files of one repository together with their cached diff sections.
+
+    Directories containing watched files and the git index are fingerprinted as well: when any of them changes,
+    files might have been added, removed or staged, and the whole working tree has to be rescanned.
+    """
+
+    def __init__(self, repo: git.Repo, extensions: List[str], full_scan_interval: int = 60):
+        self.repo = repo
+        self.root = repo.working_tree_dir
+        self.extensions = extensions
+        self.full_scan_interval = full_scan_interval
+
+        self.head: str | None = None
+        self.index_fingerprint: Fingerprint | None = None
+        self.tracked: Dict[str, Fingerprint | None] = {}
+        self.untracked: Dict[str, Fingerprint | None] = {}
+        self.directories: Dict[str, Fingerprint | None] = {}
+
+        self.tracked_patches: Dict[str, str] = {}
+        self.untracked_patches: Dict[str, str] = {}
+        self.ticks_since_scan = 0
+        self._text: str | None = None
+
+    def is_watched(self, path: str) -> bool:
+        for extension in self.extensions:
+            if path.endswith(extension):
+                return True
+        return False
+
+    def needs_full_scan(self) -> bool:
+        if self.head is None or self.ticks_since_scan >= self.full_scan_interval:
+            return True
+        if self.repo.head.commit.hexsha != self.head:
+            return True
+        if stat_fingerprint(os.path.join(self.repo.git_dir, 'index')) != self.index_fingerprint:
+            return True
+        for directory, fingerprint in self.directories.items():
+            if stat_fingerprint(directory) != fingerprint:
+                return True
+        return False
+
+    def scan(self, tracked_files: List[str], untracked_files: List[str]):
+        self.head = self.repo.head.commit.hexsha
+        self.tracked = {path: self._fingerprint(path) for path in tracked_files if self.is_watched(path)}
+        self.untracked = {path: self._fingerprint(path) for path in untracked_files if self.is_watched(path)}
+
+        directories = {self.root}
+        for path in list(self.tracked.keys()) + list(self.untracked.keys()):
+            directory = os.path.dirname(path)
+            while directory != '' and directory not in directories:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        fingerprints = {}
+        for directory in directories:
+            abs_directory = os.path.join(self.root, directory)
+            fingerprints[abs_directory] = stat_fingerprint(abs_directory)
+        self.directories = fingerprints
+
+        # taken last: `git status` may refresh the index while the file lists are collected
+        self.index_fingerprint = stat_fingerprint(os.path.join(self.repo.git_dir, 'index'))
+        self.ticks_since_scan = 0
+
+    def changed_files(self) -> Tuple[List[str], List[str]]:
+        self.ticks_since_scan += 1
+        return self._refresh(self.tracked), self._refresh(self.untracked)
+
+    def set_tracked_patches(self, patches: Dict[str, str], paths: List[str] | None = None):
+        self._merge(self.tracked_patches, patches, paths)
+
+    def set_untracked_patches(self, patches: Dict[str, str], paths: List[str] | None = None):
+        self._merge(self.untracked_patches, patches, paths)
+
+    def to_string(self) -> str:
+        if self._text is None:
+            sections = [self.tracked_patches[path] for path in sorted(self.tracked_patches.keys())]
+            sections.extend(self.untracked_patches[path] for path in sorted(self.untracked_patches.keys()))
+            self._text = ''.join(sections)
+        return self._text
+
+    def _merge(self, cache: Dict[str, str], patches: Dict[str, str], paths: List[str] | None):
+        self._text = None
+        if paths is None:
+            cache.clear()
+        else:
+            for path in paths:
+                cache.pop(path, None)
+        for path, text in patches.items():
+            cache[path] = text if text.endswith('\n') else text + '\n'
+
+    def _refresh(self, fingerprints: Dict[str, Fingerprint | None]) -> List[str]:
+        changed = []
+        for path, fingerprint in fingerprints.items():
+            current = self._fingerprint(path)
+            if current != fingerprint:
+                fingerprints[path] = current
+                changed.append(path)
+        return changed
+
+    def _fingerprint(self, path: str) -> Fingerprint | None:
+        return stat_fingerprint(os.path.join(self.root, path))
@@ -1,128 +1,196 @@
 import datetime
-from typing import Dict
-
-import git
-
-from domain.common_db import get_projects, save_commit, get_commit
-from domain.diff import Patch
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, List, Tuple
+
+from git import GitCommandError
+
+from api.commit_watch.merge_diff import get_merge_diff_mode
+from api.commit_watch.patch_worker import extract_commit_patch
+from api.git_workers.pool import worker_pool
+from api.project_runner import ProjectRunner
+from api.worker_context import worker_context
+from domain.common_db import get_projects, save_commits, get_existing_commit_hashes
 from domain.project import ProjectContext, ProjectCommit
-from models import SessionLocal
+from models import ScopedSession
 
-session = SessionLocal()
+session = ScopedSession
 
 CommitMetricsVersion = 1
+COMMIT_PATCH_WORKERS = int(os.getenv('COMMIT_PATCH_WORKERS', str(os.cpu_count() or 1)))
+COMMIT_PATCH_QUEUE = int(os.getenv('COMMIT_PATCH_QUEUE', str(COMMIT_PATCH_WORKERS * 2)))
+
+
+class BranchTips:
+    """Tip of every branch of every project as it was when its commits were last saved."""
+
+    def __init__(self):
+        self.tips: Dict[Tuple[int, str], str] = {}  # (project id, branch): commit hash
+        self.lock = threading.Lock()
+
+    def get(self, project_id: int, branch: str) -> str | None:
+        with self.lock:
+            return self.tips.get((project_id, branch))
+
+    def put(self, project_id: int, branches: Dict[str, str]):
+        with self.lock:
+            for key in [key for key in self.tips if key[0] == project_id and key[1] not in branches]:
+                self.tips.pop(key)
+            for branch, hex_hash in branches.items():
+                self.tips[(project_id, branch)] = hex_hash
 
 
 class CommitWatcher:
     def __init__(self):
         self.contexts: Dict[int, ProjectContext] = {}
-
-    def start_once(self):
+        self.branch_tips = BranchTips()
+        self.git_workers = worker_pool
+        self.runner = ProjectRunner('commit-watcher')
+        self.patch_workers = COMMIT_PATCH_WORKERS
+        self.patch_queue = COMMIT_PATCH_QUEUE
+        self.patch_executor: ProcessPoolExecutor | None = None
+        self.lock = threading.Lock()
+
+    async def start_once(self):
         projects = get_projects()
         for project in projects:
             if project.id not in self.contexts:
                 self.contexts[project.id] = ProjectContext(project)
         day = datetime.datetime.now()
-        self.process_commits(day)
-
-    # Function to convert diff to text
-    def diff_to_text(self, patch):
-        diff_text = ""
-        for diff_item in patch:
-            if diff_item.diff:
-                new_text = diff_item.diff.decode('utf-8')
-                if new_text.strip('\n\r \t') == "":
-                    continue
-
-                a_name = diff_item.a_path if diff_item.a_path is not None else "/dev/null"
-                b_name = diff_item.b_path if diff_item.b_path is not None else "/dev/null"
-
-                diff_text += f"--- {a_name}\n+++ {b_name}\n"
-                diff_text += new_text
-        yield diff_text
-
-    def get_commit_patch(self, context: ProjectContext, commit: ProjectCommit) -> Patch | None:
-        parent_commit_hash = None
-        if len(commit.parents) == 1:
-            parent_commit_hash = commit.parents[list(commit.parents.keys())[0]].hex_hash
-        else:
+        await self.runner.run(self.contexts.values(), lambda context: self.process_project_commits(context, day))
+
+    def get_patch_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.patch_executor is None:
+                self.patch_executor = ProcessPoolExecutor(max_workers=self.patch_workers, mp_context=worker_context)
+            return self.patch_executor
+
+    def extract_patches(self, context: ProjectContext,
+                        commits: Iterable[ProjectCommit]) -> Iterator[Tuple[ProjectCommit, str | None]]:
+        """Patches of the commits in the commits order, root commits and merges in the `skip` mode are left out.
+
+        At most `patch_queue` commits of the project are submitted to the worker processes at once.
+        """
+        executor = self.get_patch_executor()
+        merge_diff = get_merge_diff_mode(context.settings)
+        pending: Deque[Tuple[ProjectCommit, Future]] = deque()
+        for commit in commits:
+            if len(commit.parent_hashes) == 0 or (len(commit.parent_hashes) > 1 and merge_diff == 'skip'):
+                continue
+            print(f'processing commit `{commit.hex_hash}`: `{commit.description}`')
+            pending.append((commit, executor.submit(
+                extract_commit_patch, context.repo_path, commit.parent_hashes, commit.hex_hash, merge_diff
+            )))
+            if len(pending) >= self.patch_queue:
+                commit, future = pending.popleft()
+                yield commit, future.result()
+        while len(pending) > 0:
+            commit, future = pending.popleft()
+            yield commit, future.result()
+
+    def shutdown(self):
+        self.runner.shutdown()
+        with self.lock:
+            if self.patch_executor is not None:
+                self.patch_executor.shutdown(wait=False, cancel_futures=True)
+                self.patch_executor = None
+
+    def get_commit_info(self, context: ProjectContext, hex_hash: str, branch: str = None) -> ProjectCommit | None:
+        commit = self.git_workers.read_commit(context.repo_path, hex_hash)
+        if commit is None:
             return None
-        #     for _, parent in commit.parents.items():
-        #         if parent.author in context.emails:
-        #             parent_commit_hash = parent.author
-        #             break
-
-        parent_commit = context.repo.commit(parent_commit_hash)
-        child_commit = context.repo.commit(commit.hex_hash)
-
-        patch_obj = parent_commit.diff(child_commit, full_index=True, create_patch=True, unified=3)
-        # result = ""
-        # for diff in patch_obj:
-        #     result += diff.diff.decode('UTF-8')
-
-        diff_text = '\n'.join(list(self.diff_to_text(patch_obj)))
-
-        if diff_text != "":
-            return Patch(diff_text)
-
-        print('diff is empty')
-
-        return None
-
-    def get_commit_info(self, commit: git.Commit, branch: str = None, collect_parents: bool = False) -> ProjectCommit:
         proj_commit = ProjectCommit(
             branch=branch,
-            hex_hash=commit.hexsha.strip('\n\r\t '),
-            created_at=commit.authored_datetime,
+            hex_hash=commit.hex_hash,
+            created_at=commit.authored_at,
             description=commit.message.strip('\n\r\t '),
-            author=commit.author.email,
+            author=commit.author_email,
+            parent_hashes=list(commit.parents),
         )
-        if collect_parents:
-            for parent in commit.parents:
-                parent_commit = self.get_commit_info(parent)
-                proj_commit.parents[parent_commit.hex_hash] = parent_commit
         return proj_commit
 
-    def get_day_commits(self, context: ProjectContext, day: datetime.datetime):
-        day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_end = day.replace(hour=23, minute=59, second=59, microsecond=999999)
+    def get_branch_tips(self, context: ProjectContext) -> Dict[str, str]:
+        refs = context.repo.git.for_each_ref('--format=%(objectname) %(refname)', 'refs/heads')
+        tips = {}
+        for line in refs.splitlines():
+            hex_hash, ref = line.split(' ', 1)
+            tips[ref[len('refs/heads/'):]] = hex_hash
+        return tips
+
+    def rev_list(self, context: ProjectContext, tip: str, seen_tip: str | None,
+                 since: datetime.datetime, until: datetime.datetime) -> List[str]:
+        revisions = [tip] if seen_tip is None else [tip, f'^{seen_tip}']
         try:
-            branches = context.repo.branches
-            today_commits = []
-            commits = {}
-            for branch in branches:
-                for git_commit in context.repo.iter_commits(branch.name, since=day_start, until=day_end):
-                    commit = self.get_commit_info(git_commit, branch.name, True)
-                    commits[commit.hex_hash] = commit
-
-            for hex_hash, commit in commits.items():
-                if commit.author in context.emails:
-                    today_commits.append(commit)
-
-            return today_commits
-        except Exception as e:
-            print(f"Error fetching commits: {e}")
+            return context.repo.git.rev_list(*revisions, since=since.isoformat(), until=until.isoformat(),
+                                             author=[f'<{email}>' for email in context.emails],
+                                             fixed_strings=True).split()
+        except GitCommandError:
+            if seen_tip is None:
+                raise
+            # the seen tip is gone after a force push and gc, walk the whole window again
+            return self.rev_list(context, tip, None, since, until)
+
+    def get_new_commits(self, context: ProjectContext, day: datetime.datetime,
+                        tips: Dict[str, str]) -> List[ProjectCommit]:
+        """Commits of the project authors made yesterday or on the `day` which were not seen yet.
+
+        Only branches whose tip moved since the last saved pass are walked, from the new tip
+        down to the previous one.
+        """
+        if len(context.emails) == 0:
             return []
+        since = (day - datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        until = day.replace(hour=23, minute=59, second=59, microsecond=999999)
+        branches: Dict[str, List[str]] = {}  # commit hash: branches it was found on
+        for branch, tip in tips.items():
+            seen_tip = self.branch_tips.get(context.project.id, branch)
+            if seen_tip == tip:
+                continue
+            for hex_hash in self.rev_list(context, tip, seen_tip, since, until):
+                branches.setdefault(hex_hash, []).append(branch)
+        if len(branches) == 0:
+            return []
+
+        existing = get_existing_commit_hashes(list(branches.keys()))
+        commits = []
+        for hex_hash, commit_branches in branches.items():
+            if hex_hash in existing:
+                continue
+            commit = self.get_commit_info(context, hex_hash, commit_branches[-1])
+            if commit is not None:
+                commits.append(commit)
+        return commits
 
     def process_commits(self, day: datetime.datetime):
         result_commits = {}
-
         for project_id, context in self.contexts.items():
-            print(f'get commits for project `{context.project.name}`')
-            commits = self.get_day_commits(context, day - datetime.timedelta(days=1))
-            commits.extend(self.get_day_commits(context, day))
-
-            for commit in commits:
-                existing_commit = get_commit(commit.hex_hash)
-                if existing_commit is not None:
-                    continue
-                print(f'processing commit `{commit.hex_hash}`: `{commit.description}`')
-                patch = self.get_commit_patch(context, commit)
-                if patch is None:
-                    continue
-                commit.diff = patch.to_string()
-                print(f'collected patch for commit `{commit.hex_hash}`')
-                db_commit, _ = save_commit(context.project.id, commit)
+            result_commits.update(self.process_project_commits(context, day))
+        return result_commits
+
+    def process_project_commits(self, context: ProjectContext, day: datetime.datetime):
+        result_commits = {}
+        print(f'get commits for project `{context.project.name}`')
+        try:
+            tips = self.get_branch_tips(context)
+            commits = self.get_new_commits(context, day, tips)
+        except Exception as e:
+            print(f"Error fetching commits: {e}")
+            return result_commits
+
+        new_commits = []
+        for commit, diff in self.extract_patches(context, commits):
+            if diff is None:
+                print('diff is empty')
+                continue
+            commit.diff = diff
+            print(f'collected patch for commit `{commit.hex_hash}`')
+            new_commits.append(commit)
+
+        if len(new_commits) > 0:
+            for commit, (db_commit, _) in zip(new_commits, save_commits(context.project.id, new_commits)):
                 print(f'commit `{commit.hex_hash}` succesfully saved')
                 result_commits[db_commit.id] = commit
+        self.branch_tips.put(context.project.id, tips)
         return result_commits
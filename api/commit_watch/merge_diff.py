@@ -0,0 +1,118 @@
+import os
+import re
+from typing import List
+
+import git
+
+# how the patch of a merge commit is built, the `merge_diff` project setting overrides it
+#   skip         - merge commits are not collected
+#   first-parent - diff against the first parent, the merged branch changes are counted once more
+#   cc           - combined diff, only hunks which differ from every parent, i.e. the conflict resolutions
+#   remerge      - diff against the automatic merge with its conflict markers, needs git 2.36+
+MERGE_DIFF_MODES = ('skip', 'first-parent', 'cc', 'remerge')
+COMMIT_MERGE_DIFF = os.getenv('COMMIT_MERGE_DIFF', 'cc')
+
+_COMBINED_HUNK_HEADER = re.compile(r'^(@{2,}) (.*?) @{2,}')
+
+
+def get_merge_diff_mode(settings: dict) -> str:
+    mode = settings.get('merge_diff', COMMIT_MERGE_DIFF)
+    if mode not in MERGE_DIFF_MODES:
+        print(f'unknown merge diff mode `{mode}`, merge commits are skipped')
+        return 'skip'
+    return mode
+
+
+def read_merge_patch(repo: git.Repo, hex_hash: str, mode: str) -> str:
+    """Patch of the merge commit in the `cc` or `remerge` mode, as `--- a\\n+++ b\\n` sections of unified hunks."""
+    if mode == 'cc':
+        text = repo.git.diff_tree('--cc', '--no-commit-id', '--full-index', '-U3', hex_hash,
+                                  strip_newline_in_stdout=False)
+    else:
+        text = repo.git.show('--remerge-diff', '--format=', '--full-index', '-U3', hex_hash,
+                             strip_newline_in_stdout=False)
+    return git_patch_to_text(text)
+
+
+def git_patch_to_text(text: str) -> str:
+    """Converts `diff --git` and `diff --cc` output of git to the sections the commit watcher saves.
+
+    A combined hunk is turned into a unified one against the first parent, lines which only the other
+    parents had are dropped. Hunks and files left without changes are skipped.
+    """
+    parts = []
+    names = None
+    hunks: List[str] = []
+
+    def flush():
+        if names is not None and len(hunks) > 0:
+            parts.append(f'--- {names[0]}\n+++ {names[1]}\n')
+            parts.extend(hunks)
+
+    hunk = None
+    for line in text.splitlines(keepends=True):
+        if line.startswith('diff '):
+            if hunk is not None:
+                hunks.extend(hunk.finish())
+            flush()
+            names, hunks, hunk = ['/dev/null', '/dev/null'], [], None
+        elif names is None:
+            continue
+        elif line.startswith('@@'):
+            if hunk is not None:
+                hunks.extend(hunk.finish())
+            hunk = _Hunk(line)
+        elif hunk is not None:
+            hunk.add(line)
+        elif line.startswith('--- '):
+            names[0] = _strip_prefix(line[4:].rstrip('\n'), 'a/')
+        elif line.startswith('+++ '):
+            names[1] = _strip_prefix(line[4:].rstrip('\n'), 'b/')
+    if hunk is not None:
+        hunks.extend(hunk.finish())
+    flush()
+    return ''.join(parts)
+
+
+def _strip_prefix(name: str, prefix: str) -> str:
+    return name[len(prefix):] if name.startswith(prefix) else name
+
+
+class _Hunk:
+    __slots__ = ('parents', 'original_start', 'new_start', 'section', 'lines', 'changed', 'kept')
+
+    def __init__(self, header: str):
+        match = _COMBINED_HUNK_HEADER.match(header)
+        ranges = match.group(2).split(' ')
+        self.parents = len(match.group(1)) - 1
+        self.original_start = int(ranges[0][1:].split(',')[0])
+        self.new_start = int(ranges[-1][1:].split(',')[0])
+        self.section = header[match.end():]
+        self.lines: List[str] = []
+        self.changed = False
+        self.kept = False
+
+    def add(self, line: str):
+        if line.startswith('\\'):
+            if self.kept:
+                self.lines.append(line)
+            return
+        columns, body = line[:self.parents], line[self.parents:]
+        if '-' in columns:
+            # a line of the parents which is not in the result
+            self.kept = columns[0] == '-'
+            prefix = '-'
+        else:
+            self.kept = True
+            prefix = '+' if columns[0] == '+' else ' '
+        if self.kept:
+            self.changed = self.changed or prefix != ' '
+            self.lines.append(prefix + body)
+
+    def finish(self) -> List[str]:
+        if not self.changed:
+            return []
+        original_length = sum(1 for line in self.lines if line[0] in ' -')
+        new_length = sum(1 for line in self.lines if line[0] in ' +')
+        header = f'@@ -{self.original_start},{original_length} +{self.new_start},{new_length} @@{self.section}'
+        return [header] + self.lines
@@ -0,0 +1,46 @@
+from typing import Dict, List
+
+import git
+
+from api.commit_watch.merge_diff import read_merge_patch
+
+# functions of the commit patch worker processes, this module is imported by them and keeps off the database models
+
+# repositories opened by a patch worker process, reused by the following commits of the same repository
+_repos: Dict[str, git.Repo] = {}
+
+
+def diff_to_text(diff_index: git.DiffIndex) -> str:
+    parts = []
+    for diff_item in diff_index:
+        if not diff_item.diff:
+            continue
+        new_text = diff_item.diff.decode('utf-8')
+        if new_text.strip('\n\r \t') == "":
+            continue
+
+        a_name = diff_item.a_path if diff_item.a_path is not None else "/dev/null"
+        b_name = diff_item.b_path if diff_item.b_path is not None else "/dev/null"
+        parts.append(f"--- {a_name}\n+++ {b_name}\n")
+        parts.append(new_text)
+    return ''.join(parts)
+
+
+def extract_commit_patch(repo_path: str, parent_hashes: List[str], hex_hash: str, merge_diff: str) -> str | None:
+    """Patch text of the commit, None for an empty patch.
+
+    A commit with a single parent, or a merge in the `first-parent` mode, is diffed against its first parent,
+    other merges are read in their `merge_diff` mode.
+    """
+    repo = _repos.get(repo_path)
+    if repo is None:
+        repo = _repos[repo_path] = git.Repo(repo_path)
+    if len(parent_hashes) == 1 or merge_diff == 'first-parent':
+        diff_index = repo.commit(parent_hashes[0]).diff(repo.commit(hex_hash), full_index=True, create_patch=True,
+                                                        unified=3)
+        diff_text = diff_to_text(diff_index)
+    else:
+        diff_text = read_merge_patch(repo, hex_hash, merge_diff)
+    if diff_text == "":
+        return None
+    return diff_text
@@ -0,0 +1,89 @@
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+
+class BlobCache:
+    """LRU cache of git object contents keyed by object id and bounded by the total size of the contents."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._blobs: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, object_id: str) -> bytes | None:
+        with self.lock:
+            content = self._blobs.get(object_id)
+            if content is not None:
+                self._blobs.move_to_end(object_id)
+            return content
+
+    def put(self, object_id: str, content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self._blobs.pop(object_id, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._blobs[object_id] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self._blobs.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class CatFile:
+    """Long-lived `git cat-file --batch` process of a single repository."""
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.process: subprocess.Popen | None = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def read(self, object_name: str) -> Tuple[str, str, bytes] | None:
+        with self.lock:
+            self.last_used = time.monotonic()
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    self.process = subprocess.Popen(
+                        ['git', 'cat-file', '--batch'],
+                        cwd=self.repo_path,
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                    )
+                try:
+                    self.process.stdin.write(object_name.encode('utf-8') + b'\n')
+                    self.process.stdin.flush()
+                    header = self.process.stdout.readline().decode('utf-8').split()
+                    if len(header) != 3:
+                        return None
+                    object_id, object_type, size = header
+                    content = self.process.stdout.read(int(size))
+                    self.process.stdout.read(1)
+                    return object_id, object_type, content
+                except (BrokenPipeError, ValueError):
+                    self._close()
+            return None
+
+    def close_if_idle(self, timeout: float):
+        with self.lock:
+            if time.monotonic() - self.last_used > timeout:
+                self._close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process = None
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from api.git_workers.objects import BlobCache, CatFile
+
+GIT_WORKER_IDLE_TIMEOUT = int(os.getenv('GIT_WORKER_IDLE_TIMEOUT', '300'))
+
+
+@dataclass
+class GitCommitInfo:
+    hex_hash: str
+    tree: str
+    author: str
+    author_email: str
+    authored_at: datetime.datetime
+    committer_email: str
+    committed_at: datetime.datetime
+    message: str
+    parents: List[str] = field(default_factory=lambda: [])
+
+
+def parse_signature(value: str) -> Tuple[str, str, datetime.datetime]:
+    name, _, rest = value.partition(' <')
+    email, _, stamp = rest.partition('> ')
+    timestamp, _, offset = stamp.partition(' ')
+    sign = -1 if offset.startswith('-') else 1
+    offset = offset.lstrip('+-')
+    tz = datetime.timezone(sign * datetime.timedelta(hours=int(offset[:2] or 0), minutes=int(offset[2:4] or 0)))
+    return name, email, datetime.datetime.fromtimestamp(int(timestamp), tz=tz)
+
+
+def parse_commit(hex_hash: str, content: bytes) -> GitCommitInfo:
+    header, _, message = content.decode('utf-8', errors='replace').partition('\n\n')
+    tree = ''
+    parents = []
+    author = ('', '', datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc))
+    committer = author
+    for line in header.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            tree = value
+        elif key == 'parent':
+            parents.append(value)
+        elif key == 'author':
+            author = parse_signature(value)
+        elif key == 'committer':
+            committer = parse_signature(value)
+    return GitCommitInfo(
+        hex_hash=hex_hash,
+        tree=tree,
+        author=author[0],
+        author_email=author[1],
+        authored_at=author[2],
+        committer_email=committer[1],
+        committed_at=committer[2],
+        message=message,
+        parents=parents,
+    )
+
+
+class GitWorkerPool:
+    """Long-lived `git cat-file --batch` processes shared by all watchers, one per repository.
+
+    They serve blob reads of the diff watcher and commit headers of the commit watcher, other git commands
+    still run a process per call. Processes which were not used for `idle_timeout` seconds are stopped by
+    `reap_idle` and started again on demand.
+    """
+
+    def __init__(self, idle_timeout: float = GIT_WORKER_IDLE_TIMEOUT, cache: BlobCache | None = None):
+        self.idle_timeout = idle_timeout
+        self.cache = cache if cache is not None else BlobCache()
+        self.workers: Dict[str, CatFile] = {}  # repository path: worker
+        self.lock = threading.Lock()
+
+    def get_worker(self, repo_path: str) -> CatFile:
+        with self.lock:
+            if repo_path not in self.workers:
+                self.workers[repo_path] = CatFile(repo_path)
+            return self.workers[repo_path]
+
+    def read_object(self, repo_path: str, object_name: str, object_type: str) -> Tuple[str, bytes] | None:
+        result = self.get_worker(repo_path).read(object_name)
+        if result is None or result[1] != object_type:
+            return None
+        return result[0], result[2]
+
+    def read_blob(self, repo_path: str, object_id: str) -> bytes | None:
+        if object_id.strip('0') == '':
+            return b''
+        content = self.cache.get(object_id)
+        if content is not None:
+            return content
+
+        result = self.read_object(repo_path, object_id, 'blob')
+        if result is None:
+            return None
+        self.cache.put(result[0], result[1])
+        return result[1]
+
+    def read_commit(self, repo_path: str, commit_name: str) -> GitCommitInfo | None:
+        result = self.read_object(repo_path, commit_name, 'commit')
+        if result is None:
+            return None
+        return parse_commit(result[0], result[1])
+
+    def reap_idle(self):
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.close_if_idle(self.idle_timeout)
+
+    async def run_reaper(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 1))
+            self.reap_idle()
+
+    def close(self):
+        with self.lock:
+            workers = list(self.workers.values())
+            self.workers = {}
+        for worker in workers:
+            worker.close()
+
+
+worker_pool = GitWorkerPool()
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from api.metrics.backfill_worker import count_patch_lines
+from api.worker_context import worker_context
+from domain.common_db import PatchMetricsVersion
+from domain.db.unit_of_work import transaction
+from domain.patch_codec import patch_codec
+from models import ScopedSession, PatchBlob, PatchMetrics, ProjectPatch
+
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '500'))
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', str(os.cpu_count() or 1)))
+
+
+class MetricsBackfill:
+    """Recounts metrics of patches saved with an older `PatchMetricsVersion` in the background.
+
+    Patches are read by id in keyset pages and counted in a process pool. Every page is
+    upserted and marked with the current version in its own transaction. An interrupted run
+    therefore resumes from the first patch which is still not marked.
+    """
+
+    def __init__(self, chunk_size: int = BACKFILL_CHUNK_SIZE, workers: int = BACKFILL_WORKERS):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.total = 0
+        self.done = 0
+        self.stopped = threading.Event()
+
+    async def start(self):
+        try:
+            await asyncio.to_thread(self.run)
+        except Exception as e:
+            print(f'metrics backfill failed: {e}')
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        session = ScopedSession()
+        try:
+            self.total = session.scalar(select(func.count(ProjectPatch.id)).where(self.outdated()))
+            self.done = 0
+            if self.total == 0:
+                return
+            print(f'metrics backfill: {self.total} patches to count')
+
+            last_id = 0
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_context) as executor:
+                while not self.stopped.is_set():
+                    rows = session.execute(
+                        select(ProjectPatch.id, ProjectPatch.created_at, PatchBlob.dictionary_id, PatchBlob.data)
+                        .join(PatchBlob, PatchBlob.hash == ProjectPatch.patch_hash)
+                        .where(self.outdated(), ProjectPatch.id > last_id)
+                        .order_by(ProjectPatch.id)
+                        .limit(self.chunk_size)
+                    ).all()
+                    if len(rows) == 0:
+                        break
+                    texts = [patch_codec.decompress(row.dictionary_id, row.data) for row in rows]
+                    counts = list(executor.map(count_patch_lines, texts,
+                                               chunksize=max(1, len(rows) // (self.workers * 4))))
+                    self.save(rows, counts)
+
+                    last_id = rows[-1].id
+                    self.done += len(rows)
+                    print(f'metrics backfill: {self.done}/{self.total}')
+        finally:
+            ScopedSession.remove()
+
+    def save(self, rows: List, counts: List[Tuple[int, int]]):
+        with transaction() as session:
+            statement = insert(PatchMetrics).values([
+                {'patch_id': row.id, 'created_at': row.created_at, 'lines_added': added, 'lines_removed': removed}
+                for row, (added, removed) in zip(rows, counts)
+            ])
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[PatchMetrics.patch_id],
+                set_={
+                    'created_at': statement.excluded.created_at,
+                    'lines_added': statement.excluded.lines_added,
+                    'lines_removed': statement.excluded.lines_removed,
+                },
+            ))
+            session.execute(
+                update(ProjectPatch)
+                .where(ProjectPatch.id.in_([row.id for row in rows]))
+                .values(metric_collected=PatchMetricsVersion)
+            )
+
+    @staticmethod
+    def outdated():
+        return or_(ProjectPatch.metric_collected != PatchMetricsVersion, ProjectPatch.metric_collected == None)
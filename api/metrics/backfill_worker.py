@@ -0,0 +1,11 @@
+from typing import Tuple
+
+from domain.diff import Patch
+
+# functions of the backfill worker processes, this module is imported by them and keeps off the database models
+
+
+def count_patch_lines(text: str) -> Tuple[int, int]:
+    # the patch cache of the parent is not available in the workers
+    metrics = Patch(text).get_metrics()
+    return metrics['lines']['added'], metrics['lines']['removed']
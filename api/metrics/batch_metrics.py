@@ -1,9 +1,17 @@
-from copy import deepcopy
-from dataclasses import dataclass, field
-from typing import Tuple, Dict
-
+import base64
+import contextlib
+import json
+import threading
+import zlib
+from copy import copy
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Iterable, Set, Tuple
+
+from api.metrics.unique_lines import UNIQUE_LINES_MODE, LineSet, make_line_set, line_set_from_bytes
 from domain.db.batches import Batches
+from domain.db.unit_of_work import transaction
 from domain.diff import Patch
+from domain.patch_cache import parse_patch
 
 
 @dataclass
@@ -42,91 +50,142 @@ def to_table(metrics: Dict[str, BatchMetrics], caption: str):
     return text
 
 
+class MetricsAccumulator:
+    """Running metrics of one entity of a batch, rows linked to the batch are folded in once, in id order.
+
+    Unique lines are tracked as 64-bit hashes, exactly or approximately depending on `mode`.
+    """
+
+    def __init__(self, batch_id: int, entity: str, mode: str = UNIQUE_LINES_MODE):
+        self.batch_id = batch_id
+        self.entity = entity
+        self.mode = mode
+        self.last_row_id = 0
+        self.overall = BatchMetrics()
+        self.unique_added: LineSet = make_line_set(mode)
+        self.unique_removed: LineSet = make_line_set(mode)
+        self.unique_files: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def fold(self, row_id: int, patch: Patch):
+        diffs = patch.get_diffs()
+        additions, removals = patch.get_changes()
+        self.overall.lines_added += len(additions)
+        self.overall.lines_removed += len(removals)
+        self.overall.files_affected += len(diffs)
+        self.overall.lines_affected += len(additions) + len(removals)
+
+        self.unique_files.update(diffs)
+        self.unique_added.add_lines(additions)
+        self.unique_removed.add_lines(removals)
+        self.last_row_id = max(self.last_row_id, row_id)
+
+    def get_metrics(self) -> Tuple[BatchMetrics, BatchMetrics]:
+        unique_metrics = BatchMetrics(
+            lines_added=len(self.unique_added),
+            lines_removed=len(self.unique_removed),
+            lines_affected=self.unique_added.union_size(self.unique_removed),
+            files_affected=len(self.unique_files),
+            commits=self.overall.commits,
+        )
+        return copy(self.overall), unique_metrics
+
+    def memory_usage(self) -> int:
+        return self.unique_added.memory_usage() + self.unique_removed.memory_usage()
+
+    def to_snapshot(self) -> bytes:
+        return zlib.compress(json.dumps({
+            'mode': self.mode,
+            'overall': asdict(self.overall),
+            'added': base64.b64encode(self.unique_added.to_bytes()).decode('ascii'),
+            'removed': base64.b64encode(self.unique_removed.to_bytes()).decode('ascii'),
+            'files': list(self.unique_files),
+        }).encode('utf-8'))
+
+    @classmethod
+    def from_snapshot(cls, batch_id: int, entity: str, last_row_id: int, snapshot: bytes,
+                      mode: str = UNIQUE_LINES_MODE) -> 'MetricsAccumulator | None':
+        data = json.loads(zlib.decompress(snapshot).decode('utf-8'))
+        if data.get('mode') != mode:
+            # the batch is folded again from its first row
+            return None
+        accumulator = cls(batch_id, entity, mode)
+        accumulator.last_row_id = last_row_id
+        accumulator.overall = BatchMetrics(**data['overall'])
+        accumulator.unique_added = line_set_from_bytes(mode, base64.b64decode(data['added']))
+        accumulator.unique_removed = line_set_from_bytes(mode, base64.b64decode(data['removed']))
+        accumulator.unique_files = set(data['files'])
+        return accumulator
+
+
+def get_accumulators_memory_usage() -> int:
+    with accumulators_lock:
+        return sum(accumulator.memory_usage() for accumulator in accumulators.values())
+
+
+# (project id, entity): accumulator of the project's active batch
+accumulators: Dict[Tuple[int, str], MetricsAccumulator] = {}
+accumulators_lock = threading.Lock()
+
+
+ENTITIES = ('patch', 'commit')
+
+
 class BatchMetricsCollector:
     def __init__(self, project_id: int | None = None, batch_id: int | None = None):
         self.batches = Batches()
         self.project_id = project_id
 
     def get_patch_metrics(self) -> Tuple[BatchMetrics, BatchMetrics]:
-        patches = []
-        batch = self.batches.get_active_batch(self.project_id)
-        patches.extend(batch.project_patches)
-
-        overall_metrics = BatchMetrics()
-        unique_lines = set[str]()
-        unique_added = set[str]()
-        unique_removed = set[str]()
-        unique_files = set[str]()
-
-        for db_patch in patches:
-            patch = Patch(db_patch.patch.patch)
-            diffs = patch.get_diffs()
-            additions, removals = patch.get_changes()
-            overall_metrics.lines_added += len(additions)
-            overall_metrics.lines_removed += len(removals)
-            overall_metrics.files_affected += len(diffs)
-            overall_metrics.lines_affected += len(additions) + len(removals)
-
-            for file_name in diffs:
-                unique_files.add(file_name)
-
-            for s in additions:
-                unique_lines.add(s)
-                unique_added.add(s)
-            for s in removals:
-                unique_lines.add(s)
-                unique_removed.add(s)
-
-        affected_lines = deepcopy(unique_removed)
-        affected_lines.update(unique_added)
-
-        unique_metrics = BatchMetrics(
-            lines_added=len(unique_added),
-            lines_removed=len(unique_removed),
-            lines_affected=len(affected_lines),
-            files_affected=len(unique_files),
-            commits=overall_metrics.commits,
-        )
-        return overall_metrics, unique_metrics
+        return self.collect(['patch'])['patch']
 
     def get_commit_metrics(self) -> Tuple[BatchMetrics, BatchMetrics]:
-        commits = []
-        batch = self.batches.get_active_batch(self.project_id)
-        commits.extend(batch.commits)
-
-        overall_metrics = BatchMetrics()
-        unique_lines = set[str]()
-        unique_added = set[str]()
-        unique_removed = set[str]()
-        unique_files = set[str]()
-
-        for commit in commits:
-            patch = Patch(commit.commit.patch)
-            diffs = patch.get_diffs()
-            additions, removals = patch.get_changes()
-            overall_metrics.lines_added += len(additions)
-            overall_metrics.lines_removed += len(removals)
-            overall_metrics.files_affected += len(diffs)
-            overall_metrics.lines_affected += len(additions) + len(removals)
-
-            for file_name in diffs:
-                unique_files.add(file_name)
-
-            for s in additions:
-                unique_lines.add(s)
-                unique_added.add(s)
-            for s in removals:
-                unique_lines.add(s)
-                unique_removed.add(s)
-
-        affected_lines = deepcopy(unique_removed)
-        affected_lines.update(unique_added)
-
-        unique_metrics = BatchMetrics(
-            lines_added=len(unique_added),
-            lines_removed=len(unique_removed),
-            lines_affected=len(affected_lines),
-            files_affected=len(unique_files),
-            commits=overall_metrics.commits,
-        )
-        return overall_metrics, unique_metrics
+        return self.collect(['commit'])['commit']
+
+    def get_metrics(self) -> Dict[Tuple[str, bool], BatchMetrics]:
+        result = {}
+        for entity, (overall_metrics, unique_metrics) in self.collect(ENTITIES).items():
+            result[(entity, False)] = overall_metrics
+            result[(entity, True)] = unique_metrics
+        return result
+
+    def collect(self, entities: Iterable[str]) -> Dict[str, Tuple[BatchMetrics, BatchMetrics]]:
+        batch_id = self.batches.get_active_batch_id(self.project_id)
+        entity_accumulators = {entity: self.get_accumulator(batch_id, entity) for entity in entities}
+        with contextlib.ExitStack() as locks:
+            for entity in ENTITIES:
+                if entity in entity_accumulators:
+                    locks.enter_context(entity_accumulators[entity].lock)
+
+            rows = self.batches.get_rows_after(batch_id, {
+                entity: accumulator.last_row_id for entity, accumulator in entity_accumulators.items()
+            })
+            folded = set()
+            for entity, row_id, patch_text in rows:
+                # a commit often carries the same text as a patch captured before it, the cache parses it once
+                entity_accumulators[entity].fold(row_id, parse_patch(patch_text))
+                folded.add(entity)
+
+            with transaction():
+                for entity in folded:
+                    accumulator = entity_accumulators[entity]
+                    self.batches.save_metrics_snapshot(batch_id, entity, accumulator.last_row_id,
+                                                       accumulator.to_snapshot())
+            return {entity: accumulator.get_metrics() for entity, accumulator in entity_accumulators.items()}
+
+    def get_accumulator(self, batch_id: int, entity: str) -> MetricsAccumulator:
+        key = (self.project_id, entity)
+        with accumulators_lock:
+            accumulator = accumulators.get(key)
+            if accumulator is not None and accumulator.batch_id == batch_id:
+                return accumulator
+
+            accumulator = None
+            db_snapshot = self.batches.get_metrics_snapshot(batch_id, entity)
+            if db_snapshot is not None:
+                accumulator = MetricsAccumulator.from_snapshot(batch_id, entity, db_snapshot.last_row_id,
+                                                               db_snapshot.snapshot)
+            if accumulator is None:
+                accumulator = MetricsAccumulator(batch_id, entity)
+            accumulators[key] = accumulator
+            return accumulator
@@ -1,14 +1,31 @@
 import asyncio
 import datetime
+import os
+import time
+from typing import Dict, Tuple
 
-from api.metrics.batch_metrics import BatchMetricsCollector
-from domain.common_db import get_projects
-from domain.db.batches import Batches
+from api.metrics.batch_metrics import BatchMetrics, BatchMetricsCollector, get_accumulators_memory_usage
+from domain.async_common_db import delete_unreferenced_blobs, get_projects
+from domain.db.async_batches import AsyncBatches
+from domain.db.unit_of_work import unit_of_work
+from domain.patch_cache import patch_cache
+from models import ScopedSession
+
+PATCH_BLOB_CLEANUP_SECONDS = int(os.getenv('PATCH_BLOB_CLEANUP_SECONDS', str(24 * 3600)))
+
+
+def collect_metrics(project_id: int) -> Dict[Tuple[str, bool], BatchMetrics]:
+    # runs in a thread of the default executor, the sync queries and the patch parsing keep off the event loop
+    try:
+        return BatchMetricsCollector(project_id=project_id).get_metrics()
+    finally:
+        ScopedSession.remove()
 
 
 class Collector:
     def __init__(self):
         self.stop = False
+        self.blobs_cleaned_at: float | None = None
 
     async def stop(self):
         self.stop = False
@@ -16,32 +33,26 @@ class Collector:
     async def run(self):
         print('metrics collection has started')
         await self.run_once()
-        initial = int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp()) % 300
         while not self.stop:
-            await asyncio.sleep(2)
-            current = int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp()) % 300
-            if current < initial:
-                await self.run_once()
-            initial = current
+            now = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+            await asyncio.sleep(300 - now % 300)
+            await self.run_once()
 
     async def run_once(self):
         print('metrics collection and saving...')
-        projects = get_projects()
-        batches_db = Batches()
+        projects = await get_projects()
+        batches_db = AsyncBatches()
         for project in projects:
-            collector = BatchMetricsCollector(project_id=project.id)
-            common_patch_metrics, unique_patch_metrics = collector.get_patch_metrics()
-            common_commit_metrics, unique_commit_metrics = collector.get_commit_metrics()
-
-            metrics = {
-                ('patch', False): common_patch_metrics,
-                ('patch', True): unique_patch_metrics,
-                ('commit', False): common_commit_metrics,
-                ('commit', True): unique_commit_metrics,
-            }
-
-            for types, metric in metrics.items():
-                batches_db.add_metric(project.id, types[0], types[1],
-                                      metric.lines_added, metric.lines_removed,
-                                      metric.lines_affected, metric.files_affected)
-        print('metrics successfully saved')
+            metrics = await asyncio.to_thread(collect_metrics, project.id)
+
+            async with unit_of_work():
+                for types, metric in metrics.items():
+                    await batches_db.add_metric(project.id, types[0], types[1],
+                                                metric.lines_added, metric.lines_removed,
+                                                metric.lines_affected, metric.files_affected)
+        print(f'metrics successfully saved, unique lines take {get_accumulators_memory_usage() / 1024:.1f} KiB')
+        print(f'parsed patches cache: {patch_cache.stats()}')
+
+        if self.blobs_cleaned_at is None or time.monotonic() - self.blobs_cleaned_at >= PATCH_BLOB_CLEANUP_SECONDS:
+            self.blobs_cleaned_at = time.monotonic()
+            print(f'unreferenced patch blobs deleted: {await delete_unreferenced_blobs()}')
@@ -0,0 +1,176 @@
+import hashlib
+import math
+import os
+import sys
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, Set
+
+UNIQUE_LINES_MODE = os.getenv('UNIQUE_LINES_MODE', 'exact')  # exact or approximate
+HLL_PRECISION = int(os.getenv('HLL_PRECISION', '14'))
+
+
+def line_hash(line: str) -> int:
+    # python's own hash is salted per process, snapshots need a stable one
+    return int.from_bytes(hashlib.blake2b(line.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+
+def _to_little_endian(values: array) -> bytes:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, content: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(content)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class LineSet(ABC):
+    mode = ''
+
+    @abstractmethod
+    def add_lines(self, lines: Iterable[str]):
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def union_size(self, other: 'LineSet') -> int:
+        pass
+
+    @abstractmethod
+    def memory_usage(self) -> int:
+        pass
+
+    @abstractmethod
+    def to_bytes(self) -> bytes:
+        pass
+
+
+class ExactLineSet(LineSet):
+    """Exact set of 64-bit line hashes: a sorted `array('Q')` (8 bytes per line) plus a small set of
+    recently added hashes, which is merged into the array once it grows past an eighth of it."""
+
+    mode = 'exact'
+
+    def __init__(self, hashes: array | None = None):
+        self.sorted = hashes if hashes is not None else array('Q')
+        self.pending: Set[int] = set()
+
+    def __contains__(self, value: int) -> bool:
+        if value in self.pending:
+            return True
+        index = bisect_left(self.sorted, value)
+        return index < len(self.sorted) and self.sorted[index] == value
+
+    def __iter__(self) -> Iterator[int]:
+        yield from self.sorted
+        yield from self.pending
+
+    def __len__(self) -> int:
+        return len(self.sorted) + len(self.pending)
+
+    def add_lines(self, lines: Iterable[str]):
+        for line in lines:
+            value = line_hash(line)
+            if value not in self:
+                self.pending.add(value)
+        if len(self.pending) > max(4096, len(self.sorted) // 8):
+            self.compact()
+
+    def compact(self):
+        if len(self.pending) == 0:
+            return
+        # pending hashes are never in the array, each one goes between two slices copied without boxing the values
+        merged = array('Q')
+        start = 0
+        for value in sorted(self.pending):
+            index = bisect_left(self.sorted, value, start)
+            merged.extend(self.sorted[start:index])
+            merged.append(value)
+            start = index
+        merged.extend(self.sorted[start:])
+        self.sorted = merged
+        self.pending = set()
+
+    def union_size(self, other: 'ExactLineSet') -> int:
+        if len(other) > len(self):
+            return other.union_size(self)
+        return len(self) + sum(1 for value in other if value not in self)
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self.sorted) + sys.getsizeof(self.pending) + 36 * len(self.pending)
+
+    def to_bytes(self) -> bytes:
+        self.compact()
+        return _to_little_endian(self.sorted)
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> 'ExactLineSet':
+        return cls(_from_little_endian('Q', content))
+
+
+class HyperLogLog(LineSet):
+    """Approximate distinct count in a fixed 2^precision bytes, relative error is about 1.04 / sqrt(2^precision)."""
+
+    mode = 'approximate'
+
+    def __init__(self, precision: int = HLL_PRECISION, registers: bytearray | None = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add_lines(self, lines: Iterable[str]):
+        shift = 64 - self.precision
+        rest_mask = (1 << shift) - 1
+        registers = self.registers
+        for line in lines:
+            value = line_hash(line)
+            index = value >> shift
+            rank = shift - (value & rest_mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def __len__(self) -> int:
+        return self.estimate(self.registers)
+
+    def union_size(self, other: 'HyperLogLog') -> int:
+        return self.estimate(bytes(map(max, self.registers, other.registers)))
+
+    def estimate(self, registers: bytes | bytearray) -> int:
+        size = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        raw = alpha * size * size / sum(2.0 ** -register for register in registers)
+        zeros = registers.count(0)
+        if raw <= 2.5 * size and zeros > 0:
+            return round(size * math.log(size / zeros))
+        return round(raw)
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self.registers)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> 'HyperLogLog':
+        return cls(int(math.log2(len(content))), bytearray(content))
+
+
+def make_line_set(mode: str = UNIQUE_LINES_MODE) -> LineSet:
+    if mode == HyperLogLog.mode:
+        return HyperLogLog()
+    return ExactLineSet()
+
+
+def line_set_from_bytes(mode: str, content: bytes) -> LineSet:
+    if mode == HyperLogLog.mode:
+        return HyperLogLog.from_bytes(content)
+    return ExactLineSet.from_bytes(content)
@@ -0,0 +1,61 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List
+
+from domain.project import ProjectContext
+from models import ScopedSession
+
+PROJECT_WORKERS = int(os.getenv('PROJECT_WORKERS', '4'))
+PROJECT_TIMEOUT = int(os.getenv('PROJECT_TIMEOUT', '300'))
+
+
+class ProjectRunner:
+    """Runs per-project work in a bounded thread pool, the event loop only awaits the results.
+
+    A project whose previous run has not finished yet is skipped instead of being queued again.
+    A run exceeding its timeout (`watch_timeout` project setting or `timeout`) is not awaited any longer,
+    but the project stays busy until its thread really finishes.
+    """
+
+    def __init__(self, name: str, max_workers: int = PROJECT_WORKERS, timeout: int = PROJECT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.running: Dict[int, asyncio.Future] = {}
+
+    def is_running(self, project_id: int) -> bool:
+        future = self.running.get(project_id)
+        return future is not None and not future.done()
+
+    async def run(self, contexts: Iterable[ProjectContext], func: Callable[[ProjectContext], object]) -> List[object]:
+        loop = asyncio.get_running_loop()
+        waiters = []
+        for context in contexts:
+            if self.is_running(context.project.id):
+                print(f'{self.name}: `{context.project.name}` is still being processed, skipped')
+                continue
+            future = loop.run_in_executor(self.executor, self.call, func, context)
+            self.running[context.project.id] = future
+            waiters.append(self.wait(context, future))
+        return list(await asyncio.gather(*waiters))
+
+    def call(self, func: Callable[[ProjectContext], object], context: ProjectContext) -> object:
+        try:
+            return func(context)
+        finally:
+            # pool threads are reused by other projects, they must not keep a session with its transaction open
+            ScopedSession.remove()
+
+    async def wait(self, context: ProjectContext, future: asyncio.Future) -> object:
+        timeout = context.settings.get('watch_timeout', self.timeout)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            print(f'{self.name}: `{context.project.name}` is not processed in {timeout} seconds')
+        except Exception as e:
+            print(f'{self.name}: `{context.project.name}` processing failed: {e}')
+        return None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
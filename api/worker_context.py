@@ -0,0 +1,10 @@
+import multiprocessing
+
+# modules of the functions the process pools run, the forkserver imports them once and the workers fork from it,
+# the default preload of `__main__` would bring the whole app with its database engine into the server
+WORKER_MODULES = ['api.commit_watch.patch_worker', 'api.metrics.backfill_worker']
+
+# the pools are started from threads of a multi-threaded process, a forked worker could inherit locks held by other
+# threads, so workers are forked from a single-threaded server
+worker_context = multiprocessing.get_context('forkserver')
+worker_context.set_forkserver_preload(WORKER_MODULES)
@@ -0,0 +1,64 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from api.git_workers.pool import worker_pool
+from domain.diff_engine import ENGINES, unified_diff
+
+
+def collect_file_versions(repo_path: str, commits: int, extensions: List[str]) -> List[Tuple[str, str, str]]:
+    raw_log = subprocess.run(
+        ['git', 'log', f'-{commits}', '--no-merges', '--format=', '--raw', '--no-abbrev'],
+        cwd=repo_path, capture_output=True, text=True, check=True,
+    ).stdout
+
+    versions = []
+    for line in raw_log.splitlines():
+        if not line.startswith(':'):
+            continue
+        meta, _, path = line.partition('\t')
+        fields = meta.split()
+        if len(fields) < 5 or not path.endswith(tuple(extensions)):
+            continue
+        versions.append((path, fields[2], fields[3]))
+    return versions
+
+
+def run(repo_path: str, commits: int, extensions: List[str]):
+    versions = collect_file_versions(repo_path, commits, extensions)
+    timings = {name: 0.0 for name in ENGINES}
+    diff_lines = {name: 0 for name in ENGINES}
+
+    for path, old_blob, new_blob in versions:
+        old_content = worker_pool.read_blob(repo_path, old_blob)
+        new_content = worker_pool.read_blob(repo_path, new_blob)
+        if old_content is None or new_content is None:
+            continue
+        a = old_content.decode('utf-8', errors='replace').splitlines(keepends=True)
+        b = new_content.decode('utf-8', errors='replace').splitlines(keepends=True)
+
+        for name, engine in ENGINES.items():
+            started = time.perf_counter()
+            lines = list(unified_diff(a, b, path, path, lineterm='', engine=engine))
+            timings[name] += time.perf_counter() - started
+            diff_lines[name] += len(lines)
+
+    print(f'{len(versions)} file versions from the last {commits} commits of {repo_path}')
+    print(f'|{"Engine":^15}|{"Seconds":^15}|{"Diff lines":^15}|')
+    for name in ENGINES:
+        print(f'|{name:>15}|{timings[name]:>15.3f}|{diff_lines[name]:>15}|')
+    worker_pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare diff engines on file changes from a git history')
+    parser.add_argument('repo_path')
+    parser.add_argument('--commits', type=int, default=200)
+    parser.add_argument('--extensions', nargs='+', default=['py', 'json', 'sql', 'js', 'ts'])
+    args = parser.parse_args()
+    run(args.repo_path, args.commits, args.extensions)
@@ -0,0 +1,175 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+from typing import Iterator, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import desc, literal, select, text, union_all
+from sqlalchemy.engine import Connection
+
+from models import engine, Batch, BatchCodeMetrics, BatchMetricsSnapshot, BatchProjectCommit, BatchProjectPatch, \
+    BatchPatchSnapshot, BatchTimeRollup, BatchWorklog, PatchBlob, ProjectCommit, ProjectPatch, \
+    AssistantThread, Worklog
+
+# rows are seeded in the transaction of the check and rolled back with it
+SEED_SQL = [
+    "INSERT INTO projects (id, name, enabled) SELECT -n, 'plan check ' || n, true FROM generate_series(1, 20) n",
+    "INSERT INTO patch_blobs (hash, size, data) "
+    "SELECT md5('plan check ' || n), 5, 'patch'::bytea FROM generate_series(1, :rows) n",
+    "INSERT INTO project_patches (id, project_id, branch_name, patch_hash, processed, metric_collected) "
+    "SELECT -n, -(n % 20 + 1), 'main', md5('plan check ' || n), true, 2 FROM generate_series(1, :rows) n",
+    "INSERT INTO project_commits (id, project_id, branch_name, branch_commit, patch_hash, commit_message, "
+    "metric_collected) "
+    "SELECT -n, -(n % 20 + 1), 'main', md5(n::text), md5('plan check ' || n), 'message', true "
+    "FROM generate_series(1, :rows) n",
+    "INSERT INTO batches (id, created_at, name, is_active, is_processed, project_id) "
+    "SELECT -n, now() - n * interval '1 day', '', n <= 20, n > 100, -(n % 20 + 1) FROM generate_series(1, :batches) n",
+    "INSERT INTO batch_project_patches (id, created_at, batch_id, patch_id) "
+    "SELECT -n, now() - n * interval '1 minute', -(n % :batches + 1), -n FROM generate_series(1, :rows) n",
+    "INSERT INTO batch_project_commits (id, created_at, batch_id, commit_id) "
+    "SELECT -n, now(), -(n % :batches + 1), -n FROM generate_series(1, :rows) n",
+    "INSERT INTO worklogs (id, project_id, task_code, work_seconds, externally_saved, summary, details) "
+    "SELECT -n, -(n % 20 + 1), 'TASK-1', 60, n > 50, '', '' FROM generate_series(1, :rows) n",
+    "INSERT INTO batch_worklogs (id, batch_id, worklog_id) "
+    "SELECT -n, -(n % :batches + 1), -n FROM generate_series(1, :rows) n",
+    "INSERT INTO batch_code_metrics_log (id, created_at, entity, is_unique, batch_id, added_lines, removed_lines, "
+    "affected_lines, affected_files, delta_added_lines, delta_removed_lines, delta_affected_lines, "
+    "delta_affected_files) "
+    "SELECT -n, now() - n * interval '1 minute', CASE WHEN n % 2 = 0 THEN 'patch' ELSE 'commit' END, n % 4 < 2, "
+    "-(n % :batches + 1), n, 0, n, 1, 1, 0, 1, 0 FROM generate_series(1, :rows) n",
+    "INSERT INTO batch_time_rollup (id, created_at, batch_id, metric_id, start_dt, end_dt, time_elapsed, "
+    "lines_amount, efficiency) "
+    "SELECT -n, now() - n * interval '1 minute', -(n % :batches + 1), -n, now(), now(), 60, 1, 1 "
+    "FROM generate_series(1, :rows) n",
+    "INSERT INTO batch_metrics_snapshots (id, entity, batch_id, last_row_id, snapshot) "
+    "SELECT -n, CASE WHEN n % 2 = 0 THEN 'patch' ELSE 'commit' END, -(n % :batches + 1), 0, '' "
+    "FROM generate_series(1, :batches) n",
+    "INSERT INTO batch_patch_snapshots (id, batch_id, is_base, size, data) "
+    "SELECT -n, -(n % :batches + 1), n % 10 = 0, 5, 'patch'::bytea FROM generate_series(1, :rows) n",
+    "INSERT INTO openai_assistant_threads (id, project_id, assistant_type, reason, session_id, closed_at) "
+    "SELECT -n, -(n % 20 + 1), 'worklog', '', 'session ' || n, CASE WHEN n > 20 THEN now() END "
+    "FROM generate_series(1, :batches) n",
+]
+
+SEEDED_TABLES = [
+    'projects', 'patch_blobs', 'project_patches', 'project_commits', 'batches', 'batch_project_patches', 'batch_project_commits',
+    'worklogs', 'batch_worklogs', 'batch_code_metrics_log', 'batch_time_rollup', 'batch_metrics_snapshots',
+    'batch_patch_snapshots', 'openai_assistant_threads',
+]
+
+
+def hot_queries() -> List[Tuple[str, object, List[str]]]:
+    """(query, statement, indexes it has to use) for the lookups of domain.db.batches and domain.common_db."""
+    day_ago = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=1)
+    rows_after = union_all(
+        select(literal('patch').label('entity'), BatchProjectPatch.id, PatchBlob.data).join(
+            ProjectPatch, ProjectPatch.id == BatchProjectPatch.patch_id
+        ).join(
+            PatchBlob, PatchBlob.hash == ProjectPatch.patch_hash
+        ).where(BatchProjectPatch.batch_id == -5, BatchProjectPatch.id > -100),
+        select(literal('commit').label('entity'), BatchProjectCommit.id, PatchBlob.data).join(
+            ProjectCommit, ProjectCommit.id == BatchProjectCommit.commit_id
+        ).join(
+            PatchBlob, PatchBlob.hash == ProjectCommit.patch_hash
+        ).where(BatchProjectCommit.batch_id == -5, BatchProjectCommit.id > -100),
+    ).subquery()
+    return [
+        ('get_commit', select(ProjectCommit).where(ProjectCommit.branch_commit == 'c4ca4238a0b923820dcc509a6f75849b'),
+         ['ix_project_commits_branch_commit']),
+        ('save_commits', select(ProjectCommit).where(ProjectCommit.branch_commit.in_(['a', 'b', 'c'])),
+         ['ix_project_commits_branch_commit']),
+        ('get_last_metrics', select(BatchCodeMetrics).where(
+            BatchCodeMetrics.batch_id == -5,
+            BatchCodeMetrics.entity == 'patch',
+            BatchCodeMetrics.is_unique == True,
+        ).order_by(desc(BatchCodeMetrics.created_at)).limit(1),
+         ['ix_batch_code_metrics_log_batch_entity_created']),
+        ('roll_active_batch', select(Batch).where(Batch.is_active == True, Batch.project_id == -5),
+         ['ix_batches_project_active']),
+        ('get_non_processed_batches', select(Batch).where(Batch.is_processed == False, Batch.project_id == -5),
+         ['ix_batches_project_not_processed']),
+        ('get_patches_in_range', select(BatchProjectPatch).where(
+            BatchProjectPatch.batch_id == -5,
+            BatchProjectPatch.created_at >= day_ago,
+            BatchProjectPatch.created_at <= datetime.datetime.now(tz=datetime.timezone.utc),
+        ), ['ix_batch_project_patches_batch_created']),
+        ('get_rows_after', select(rows_after).order_by(rows_after.c.entity, rows_after.c.id),
+         ['ix_batch_project_patches_batch_row', 'ix_batch_project_commits_batch_row']),
+        ('get_worklogs', select(BatchWorklog).where(BatchWorklog.batch_id == -5), ['ix_batch_worklogs_batch']),
+        ('select_non_saved_worklogs', select(Worklog).where(
+            Worklog.project_id == -5,
+            Worklog.externally_saved == False,
+        ), ['ix_worklogs_project_not_saved']),
+        ('get_metrics_snapshot', select(BatchMetricsSnapshot).where(
+            BatchMetricsSnapshot.batch_id == -5,
+            BatchMetricsSnapshot.entity == 'patch',
+        ), ['ix_batch_metrics_snapshots_batch_id']),
+        ('get_patch_state', select(BatchPatchSnapshot).where(
+            BatchPatchSnapshot.batch_id == -5,
+            BatchPatchSnapshot.id >= -100,
+        ).order_by(BatchPatchSnapshot.id), ['ix_batch_patch_snapshots_batch_row']),
+        ('append_time_rollup', select(BatchTimeRollup).where(
+            BatchTimeRollup.batch_id == -5,
+        ).order_by(desc(BatchTimeRollup.created_at)).limit(1), ['ix_batch_time_rollup_batch_created']),
+        ('get_openai_session_by_id', select(AssistantThread).where(AssistantThread.session_id == 'session 5'),
+         ['ix_openai_assistant_threads_session']),
+        ('get_openai_session', select(AssistantThread).where(
+            AssistantThread.project_id == -5,
+            AssistantThread.assistant_type == 'worklog',
+            AssistantThread.closed_at == None,
+        ), ['ix_openai_assistant_threads_open']),
+    ]
+
+
+def iter_plan_nodes(node: dict) -> Iterator[dict]:
+    yield node
+    for child in node.get('Plans', []):
+        yield from iter_plan_nodes(child)
+
+
+def explain(connection: Connection, statement) -> dict:
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    result = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}').scalar()
+    plan = result if isinstance(result, list) else json.loads(result)
+    return plan[0]['Plan']
+
+
+def run(rows: int, batches: int, verbose: bool) -> bool:
+    passed = True
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for sql in SEED_SQL:
+                connection.execute(text(sql), {'rows': rows, 'batches': batches})
+            for table in SEEDED_TABLES:
+                connection.exec_driver_sql(f'ANALYZE {table}')
+
+            print(f'|{"Query":^28}|{"Result":^8}|{"Scans":^70}|')
+            for name, statement, expected_indexes in hot_queries():
+                plan = explain(connection, statement)
+                nodes = list(iter_plan_nodes(plan))
+                used_indexes = {node['Index Name'] for node in nodes if 'Index Name' in node}
+                seq_scans = [node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan']
+                ok = all(index in used_indexes for index in expected_indexes)
+                passed = passed and ok
+                scans = ', '.join(sorted(used_indexes) + [f'seq {table}' for table in seq_scans])
+                print(f'|{name:>28}|{"ok" if ok else "FAILED":^8}|{scans:<70}|')
+                if verbose or not ok:
+                    print(json.dumps(plan, indent=2))
+        finally:
+            transaction.rollback()
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check on a seeded local database that the hot lookups of the batches and common db '
+                    'modules are answered by their indexes, the seeded rows are rolled back')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--batches', type=int, default=2000)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.rows, args.batches, args.verbose) else 1)
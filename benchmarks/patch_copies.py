@@ -0,0 +1,112 @@
+import argparse
+import os
+import random
+import sys
+import time
+from copy import deepcopy
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from domain.diff import FilePatch, Patch
+from domain.diff_engine import unified_diff
+
+
+def generate_files(size: int, seed: int) -> Dict[str, Tuple[List[str], List[str]]]:
+    """Changed files whose patch built by `build_patch` takes about `size` bytes."""
+    rnd = random.Random(seed)
+    files = {}
+    total = 0
+    index = 0
+    while total < size:
+        name = f'pkg/module_{index}.{"py" if index % 4 else "md"}'
+        original = [f'    value_{index}_{line} = compute({line}, {rnd.randint(0, 1000)})\n' for line in range(400)]
+        changed = list(original)
+        for _ in range(40):
+            position = rnd.randrange(len(changed))
+            if rnd.random() < 0.5:
+                changed[position] = f'    changed_{index}_{position} = {rnd.random()}\n'
+            else:
+                changed.insert(position, f'    inserted_{index}_{position} = {rnd.random()}\n')
+        files[name] = (original, changed)
+        total += len(build_section(name, original, changed))
+        index += 1
+    return files
+
+
+def build_section(name: str, original: List[str], changed: List[str]) -> str:
+    return f'diff --git a/{name} b/{name}\n' + ''.join(unified_diff(original, changed, f'a/{name}', f'b/{name}'))
+
+
+def build_patch(files: Dict[str, Tuple[List[str], List[str]]]) -> str:
+    return ''.join(build_section(name, original, changed) for name, (original, changed) in files.items())
+
+
+def deepcopy_filter(patch: Patch, extensions: List[str]) -> Patch:
+    # the way the extension filter worked before file patches were shared, a file patch keeps offsets into the
+    # patch text in packed arrays now, so its deep copy no longer costs what a copy of its line lists did
+    result = Patch([], True)
+    for key in patch.get_diffs():
+        if key.endswith(tuple(extensions)):
+            result.diffs[key] = deepcopy(patch.get_diffs()[key])
+    result._text = ''.join(file_diff.to_full_string() for file_diff in result.get_diffs().values())
+    return result
+
+
+def deepcopy_apply(file_patch: FilePatch, text: List[str]) -> List[str]:
+    result = []
+    prev_chunk_end = 0
+    for chunk in file_patch.chunks:
+        if prev_chunk_end < chunk.original_start:
+            result.extend(text[prev_chunk_end:chunk.original_start])
+        lines_to_apply = deepcopy(text[chunk.original_start:chunk.original_last_line]) \
+            if chunk.original_length > 0 else []
+        result.extend(chunk.apply(lines_to_apply))
+        prev_chunk_end = chunk.original_start + chunk.original_length
+    if len(text) > prev_chunk_end:
+        result.extend(text[prev_chunk_end:])
+    return result
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(size: int, repeat: int, seed: int):
+    files = generate_files(size, seed)
+    text = build_patch(files)
+    patch = Patch(text)
+    diffs = patch.get_diffs()
+    for name in diffs:
+        diffs[name]  # parse every file up front, both variants start from the same parsed patch
+
+    def apply_all(apply: Callable[[FilePatch, List[str]], List[str]]):
+        for name, (original, changed) in files.items():
+            assert apply(diffs[name], original) == changed
+
+    timings = [
+        ('filter', measure(lambda: deepcopy_filter(patch, ['py']), repeat),
+         measure(lambda: patch.get_files_with_extensions_only(['py']), repeat)),
+        ('apply', measure(lambda: apply_all(deepcopy_apply), repeat),
+         measure(lambda: apply_all(FilePatch.apply), repeat)),
+    ]
+
+    print(f'{len(text) / 1024 / 1024:.1f} MB patch of {len(files)} files, best of {repeat}')
+    print(f'|{"Operation":^15}|{"deepcopy, s":^15}|{"shared, s":^15}|{"Speedup":^15}|')
+    for operation, copied, shared in timings:
+        print(f'|{operation:>15}|{copied:>15.3f}|{shared:>15.3f}|{copied / shared:>14.1f}x|')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare deepcopy based and shared patch filtering and applying')
+    parser.add_argument('--size', type=int, default=5 * 1024 * 1024, help='approximate patch size in bytes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    run(args.size, args.repeat, args.seed)
@@ -0,0 +1,120 @@
+import datetime
+import os
+from typing import List
+
+from sqlalchemy import select, text, update
+
+from domain.db.unit_of_work import unit_of_work
+from models import Project, Worklog as DBWorklog, AssistantThread, Batch
+
+# blobs have to be unreferenced for this long before they are deleted, rows referencing a new blob may still be
+# uncommitted
+PATCH_BLOB_GRACE_SECONDS = int(os.getenv('PATCH_BLOB_GRACE_SECONDS', str(24 * 3600)))
+PATCH_BLOB_CLEANUP_CHUNK = int(os.getenv('PATCH_BLOB_CLEANUP_CHUNK', '1000'))
+
+# created_at is checked on the deleted row itself, a blob referenced again meanwhile is re-checked and skipped
+DELETE_UNREFERENCED_BLOBS_SQL = '''
+DELETE FROM patch_blobs
+WHERE created_at < :used_before AND hash IN (
+    SELECT b.hash
+    FROM patch_blobs b
+    WHERE b.created_at < :used_before
+        AND NOT EXISTS (SELECT 1 FROM project_patches p WHERE p.patch_hash = b.hash)
+        AND NOT EXISTS (SELECT 1 FROM project_commits c WHERE c.patch_hash = b.hash)
+        AND NOT EXISTS (SELECT 1 FROM batches t WHERE t.last_patch_hash = b.hash)
+    LIMIT :limit
+);
+'''
+
+
+async def get_projects() -> List[Project]:
+    async with unit_of_work() as session:
+        result = await session.scalars(select(Project).where(Project.enabled == True))
+        return list(result.all())
+
+
+async def get_openai_session_by_id(session_id: str) -> AssistantThread | None:
+    async with unit_of_work() as session:
+        return await session.scalar(select(AssistantThread).where(AssistantThread.session_id == session_id))
+
+
+async def get_openai_session(project_id, assistant_type: str) -> AssistantThread | None:
+    async with unit_of_work() as session:
+        return await session.scalar(select(AssistantThread).where(
+            AssistantThread.project_id == project_id,
+            AssistantThread.assistant_type == assistant_type,
+            AssistantThread.closed_at == None,
+        ))
+
+
+async def update_openai_session(session_id: str) -> AssistantThread | None:
+    async with unit_of_work():
+        thread = await get_openai_session_by_id(session_id)
+        if thread is None:
+            return None
+        thread.last_user_message_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        return thread
+
+
+async def close_openai_session(session_id: str) -> bool:
+    async with unit_of_work():
+        thread = await get_openai_session_by_id(session_id)
+        if thread is None:
+            return False
+        thread.closed_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        return True
+
+
+async def create_openai_session(project_id, assistant_type, session_id: str, reason: str) -> AssistantThread:
+    async with unit_of_work() as session:
+        thread = AssistantThread(
+            created_at=datetime.datetime.now(tz=datetime.timezone.utc),
+            project_id=project_id,
+            assistant_type=assistant_type,
+            session_id=session_id,
+            reason=reason,
+        )
+        session.add(thread)
+        return thread
+
+
+async def mark_batches_as_processed(batches: List[Batch]) -> bool:
+    async with unit_of_work() as session:
+        await session.execute(
+            update(Batch).where(Batch.id.in_([batch.id for batch in batches])).values(is_processed=True)
+        )
+    for batch in batches:
+        batch.is_processed = True
+    return True
+
+
+async def select_non_saved_worklogs(project_id: int) -> List[DBWorklog]:
+    async with unit_of_work() as session:
+        result = await session.scalars(select(DBWorklog).where(
+            DBWorklog.project_id == project_id,
+            DBWorklog.externally_saved == False
+        ))
+        return list(result.all())
+
+
+async def mark_worklog_as_saved(worklogs: List[DBWorklog]):
+    async with unit_of_work() as session:
+        await session.execute(
+            update(DBWorklog).where(
+                DBWorklog.id.in_([worklog.id for worklog in worklogs])
+            ).values(externally_saved=True)
+        )
+    for worklog in worklogs:
+        worklog.externally_saved = True
+
+
+async def delete_unreferenced_blobs() -> int:
+    used_before = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(seconds=PATCH_BLOB_GRACE_SECONDS)
+    deleted = 0
+    while True:
+        async with unit_of_work() as session:
+            result = await session.execute(text(DELETE_UNREFERENCED_BLOBS_SQL),
+                                           {'used_before': used_before, 'limit': PATCH_BLOB_CLEANUP_CHUNK})
+        deleted += result.rowcount
+        if result.rowcount < PATCH_BLOB_CLEANUP_CHUNK:
+            return deleted
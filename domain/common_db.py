@@ -1,16 +1,16 @@
 import datetime
-from typing import Tuple, List
-
-from sqlalchemy import or_
+from typing import Tuple, List, Set
 
 from domain.db.batches import Batches
+from domain.db.unit_of_work import transaction, commit_or_flush
 from domain.diff import Patch
+from domain.patch_cache import parse_patch
 from domain.project import ProjectContext, ProjectCommit
 from domain.worklog import Worklog
-from models import SessionLocal, Project, ProjectPatch, PatchMetrics, Worklog as DBWorklog, ProjectCommit as DBCommit, \
+from models import ScopedSession, Project, ProjectPatch, PatchMetrics, Worklog as DBWorklog, ProjectCommit as DBCommit, \
     AssistantThread, Batch
 
-session = SessionLocal()
+session = ScopedSession
 
 PatchMetricsVersion = 2
 
@@ -20,117 +20,144 @@ def get_projects():
     return projects
 
 
-def save_patch_metrics_to_db(patch_id: int):
-    print(f"Saving metrics of {patch_id}")
-    db_patch = session.query(ProjectPatch).filter(ProjectPatch.id == patch_id).one_or_none()
-    if db_patch is None:
-        print("Patch is not found")
-        return
-
-    patch = Patch(db_patch.patch)
+def build_patch_metrics(db_patch: ProjectPatch, patch: Patch,
+                        patch_metrics: PatchMetrics | None = None) -> PatchMetrics:
     metrics = patch.get_metrics()
-
-    patch_metrics = session.query(PatchMetrics).filter(PatchMetrics.patch_id == patch_id).one_or_none()
     if patch_metrics is None:
-        patch_metrics = PatchMetrics(
-            created_at=db_patch.created_at,
-            patch_id=db_patch.id,
-            lines_added=metrics['lines']['added'],
-            lines_removed=metrics['lines']['removed'],
-        )
-        db_patch.metric_collected = PatchMetricsVersion
-        session.add(patch_metrics)
-    else:
-        patch_metrics.created_at = db_patch.created_at
-        patch_metrics.patch_id = db_patch.id
-        patch_metrics.lines_added = metrics['lines']['added']
-        patch_metrics.lines_removed = metrics['lines']['removed']
-
-    session.commit()
-
-
-def save_diff_to_db(context: ProjectContext, essential_diff: str, whole_diff: str) -> ProjectPatch:
+        patch_metrics = PatchMetrics()
+    patch_metrics.created_at = db_patch.created_at
+    patch_metrics.patch_id = db_patch.id
+    patch_metrics.lines_added = metrics['lines']['added']
+    patch_metrics.lines_removed = metrics['lines']['removed']
+    db_patch.metric_collected = PatchMetricsVersion
+    return patch_metrics
+
+
+def save_diff_to_db(context: ProjectContext, essential_diff: str, whole_diff: str,
+                    patch: Patch | None = None) -> ProjectPatch:
     print("Saving diff")
-    patch = ProjectPatch(
-        project_id=context.project.id,
-        branch_name=context.current_branch,
-        branch_commit=context.current_commit,
-        created_at=datetime.datetime.now(tz=datetime.timezone.utc),
-        patch=essential_diff
-    )
-    session.add(patch)
-    session.commit()
+    return save_diffs_to_db(context, [(essential_diff, patch)])[0]
 
-    save_patch_metrics_to_db(patch.id)
-    batches = Batches()
 
-    batch = batches.get_active_batch(context.project.id)
-    batches.add_patch(batch.id, patch.id)
+def save_diffs_to_db(context: ProjectContext, diffs: List[Tuple[str, Patch | None]]) -> List[ProjectPatch]:
+    """Saves patches, their metrics and batch links in one transaction.
 
-    return patch
+    Metrics are counted from the given parsed patches, a patch is parsed only when it is None.
+    """
+    if len(diffs) == 0:
+        return []
+    with transaction():
+        created_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        db_patches = [
+            ProjectPatch(
+                project_id=context.project.id,
+                branch_name=context.current_branch,
+                branch_commit=context.current_commit,
+                created_at=created_at,
+                patch=diff,
+            ) for diff, _ in diffs
+        ]
+        session.add_all(db_patches)
+        session.flush()
 
+        for db_patch, (diff, patch) in zip(db_patches, diffs):
+            session.add(build_patch_metrics(db_patch, patch if patch is not None else parse_patch(diff)))
 
-def save_worklog(project_id: int, worklog: Worklog) -> Worklog:
-    print("Saving worklog")
-    worklog = DBWorklog(
-        project_id=project_id,
-        task_code=worklog.task_code,
-        work_started_at=worklog.time_start,
-        work_seconds=worklog.time_spent_seconds,
-        externally_saved=False,
-        summary=worklog.brief,
-        details='\n'.join(worklog.logs),
-    )
-    session.add(worklog)
-    session.commit()
+        batches = Batches()
+        batch_id = batches.get_active_batch_id(context.project.id)
+        batches.add_patches(batch_id, [db_patch.id for db_patch in db_patches])
 
-    batches = Batches()
+    return db_patches
 
-    batch = batches.get_active_batch(project_id)
-    batches.add_worklog(batch.id, worklog.id)
 
-    # save_patch_metrics_to_db(worklog.id)
-    return worklog
+def save_worklog(project_id: int, worklog: Worklog) -> DBWorklog:
+    print("Saving worklog")
+    return save_worklogs(project_id, [worklog])[0]
+
+
+def save_worklogs(project_id: int, worklogs: List[Worklog]) -> List[DBWorklog]:
+    if len(worklogs) == 0:
+        return []
+    with transaction():
+        db_worklogs = [
+            DBWorklog(
+                project_id=project_id,
+                task_code=worklog.task_code,
+                work_started_at=worklog.time_start,
+                work_seconds=worklog.time_spent_seconds,
+                externally_saved=False,
+                summary=worklog.brief,
+                details='\n'.join(worklog.logs),
+            ) for worklog in worklogs
+        ]
+        session.add_all(db_worklogs)
+        session.flush()
+
+        batches = Batches()
+        batch_id = batches.get_active_batch_id(project_id)
+        batches.add_worklogs(batch_id, [db_worklog.id for db_worklog in db_worklogs])
+
+    return db_worklogs
 
 
 def get_commit(commit_hex_hash: str) -> DBCommit:
     return session.query(DBCommit).filter(DBCommit.branch_commit == commit_hex_hash).one_or_none()
 
 
-def save_commit(project_id: int, commit: ProjectCommit) -> Tuple[DBCommit, bool]:
-    existing_commit = session.query(DBCommit).filter(DBCommit.branch_commit == commit.hex_hash).one_or_none()
-    if existing_commit is not None:
-        return existing_commit, False
-
-    db_commit = DBCommit(
-        project_id=project_id,
-        created_at=datetime.datetime.now(),
-        committed_at=commit.created_at,
-        branch_name=commit.branch,
-        branch_commit=commit.hex_hash,
-        patch=commit.diff,
-        commit_message=commit.description,
-        metric_collected=False,
-    )
-    session.add(db_commit)
-    session.commit()
+def get_existing_commit_hashes(commit_hex_hashes: List[str]) -> Set[str]:
+    if len(commit_hex_hashes) == 0:
+        return set()
+    return {
+        row.branch_commit
+        for row in session.query(DBCommit.branch_commit).filter(DBCommit.branch_commit.in_(commit_hex_hashes)).all()
+    }
 
-    batches = Batches()
 
-    batch = batches.get_active_batch(project_id)
-    batches.add_commit(batch.id, db_commit.id)
-
-    # save_patch_metrics_to_db(worklog.id)
-    return db_commit, True
-
-
-def update_missing_metrics():
-    db_patches = session.query(ProjectPatch).filter(or_(
-        ProjectPatch.metric_collected != PatchMetricsVersion,
-        ProjectPatch.metric_collected == None,
-    )).all()
-    for patch in db_patches:
-        save_patch_metrics_to_db(patch.id)
+def save_commit(project_id: int, commit: ProjectCommit) -> Tuple[DBCommit, bool]:
+    return save_commits(project_id, [commit])[0]
+
+
+def save_commits(project_id: int, commits: List[ProjectCommit]) -> List[Tuple[DBCommit, bool]]:
+    """Saves commits which are not stored yet and links them to the active batch in one transaction.
+
+    Returns the stored commit for each given one and whether it was created by this call.
+    """
+    with transaction():
+        hashes = [commit.hex_hash for commit in commits]
+        existing = {
+            db_commit.branch_commit: db_commit
+            for db_commit in session.query(DBCommit).filter(DBCommit.branch_commit.in_(hashes)).all()
+        }
+
+        result = []
+        new_commits = []
+        for commit in commits:
+            if commit.hex_hash in existing:
+                result.append((existing[commit.hex_hash], False))
+                continue
+            db_commit = DBCommit(
+                project_id=project_id,
+                created_at=datetime.datetime.now(),
+                committed_at=commit.created_at,
+                branch_name=commit.branch,
+                branch_commit=commit.hex_hash,
+                patch=commit.diff,
+                commit_message=commit.description,
+                metric_collected=False,
+            )
+            existing[commit.hex_hash] = db_commit
+            new_commits.append(db_commit)
+            result.append((db_commit, True))
+
+        if len(new_commits) > 0:
+            session.add_all(new_commits)
+            session.flush()
+
+            batches = Batches()
+            batch_id = batches.get_active_batch_id(project_id)
+            batches.add_commits(batch_id, [db_commit.id for db_commit in new_commits])
+
+    return result
 
 
 def get_openai_session_by_id(session_id: str) -> AssistantThread | None:
@@ -152,7 +179,7 @@ def update_openai_session(session_id: str) -> AssistantThread | None:
     if thread is None:
         return None
     thread.last_user_message_at = datetime.datetime.now(tz=datetime.timezone.utc)
-    session.commit()
+    commit_or_flush(session)
     return thread
 
 
@@ -161,7 +188,7 @@ def close_openai_session(session_id: str) -> bool:
     if thread is None:
         return False
     thread.closed_at = datetime.datetime.now(tz=datetime.timezone.utc)
-    session.commit()
+    commit_or_flush(session)
     return True
 
 
@@ -174,14 +201,14 @@ def create_openai_session(project_id, assistant_type, session_id: str, reason: s
         reason=reason,
     )
     session.add(thread)
-    session.commit()
+    commit_or_flush(session)
     return thread
 
 
 def mark_batches_as_processed(batches: List[Batch]) -> bool:
     for batch in batches:
         batch.is_processed = True
-    session.commit()
+    commit_or_flush(session)
     return True
 
 
@@ -195,4 +222,4 @@ def select_non_saved_worklogs(project_id: int):
 def mark_worklog_as_saved(worklogs: List[DBWorklog]):
     for worklog in worklogs:
         worklog.externally_saved = True
-    session.commit()
+    commit_or_flush(session)
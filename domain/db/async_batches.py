@@ -0,0 +1,172 @@
+import datetime
+from typing import List
+
+from sqlalchemy import desc, select, text
+from sqlalchemy.orm import selectinload
+
+from domain.db.batches import TIME_ROLLUP_SQL, active_batches, batch_expires_at, build_time_rollup, is_time_reported
+from domain.db.unit_of_work import unit_of_work
+from models import Project, Batch, BatchWorklog, BatchProjectPatch, Worklog, BatchCodeMetrics, BatchTimeRollup, \
+    ProjectPatch
+
+
+class AsyncBatches:
+    """Async counterpart of Batches, every method runs in the current unit of work or opens its own one."""
+
+    async def get_batch(self, batch_id: int) -> Batch | None:
+        async with unit_of_work() as session:
+            return await session.scalar(
+                select(Batch).options(
+                    selectinload(Batch.worklogs).selectinload(BatchWorklog.worklog),
+                ).where(Batch.id == batch_id)
+            )
+
+    async def get_last_metrics(self, project_id: int, entity: str, is_unique: bool) -> BatchCodeMetrics | None:
+        async with unit_of_work() as session:
+            batch_id = await self.get_active_batch_id(project_id)
+            return await session.scalar(
+                select(BatchCodeMetrics).where(
+                    BatchCodeMetrics.batch_id == batch_id,
+                    BatchCodeMetrics.entity == entity,
+                    BatchCodeMetrics.is_unique == is_unique,
+                ).order_by(
+                    desc(BatchCodeMetrics.created_at)
+                ).limit(1)
+            )
+
+    async def get_non_processed_batches(self, project_id) -> List[Batch]:
+        async with unit_of_work() as session:
+            result = await session.scalars(
+                select(Batch).where(
+                    Batch.is_processed == False,
+                    Batch.project_id == project_id
+                )
+            )
+            return list(result.all())
+
+    async def get_active_batch_id(self, project_id: int) -> int:
+        batch_id = active_batches.get(project_id)
+        if batch_id is None:
+            batch_id = (await self.roll_active_batch(project_id)).id
+        return batch_id
+
+    async def get_active_batch(self, project_id: int) -> Batch:
+        batch_id = active_batches.get(project_id)
+        if batch_id is not None:
+            async with unit_of_work() as session:
+                active_batch = await session.get(Batch, batch_id)
+            if active_batch is not None:
+                return active_batch
+        return await self.roll_active_batch(project_id)
+
+    async def roll_active_batch(self, project_id: int) -> Batch:
+        async with unit_of_work() as session:
+            # same project row lock as Batches.roll_active_batch takes
+            await session.execute(select(Project.id).where(Project.id == project_id).with_for_update())
+            active_batch = await session.scalar(
+                select(Batch).where(
+                    Batch.is_active == True,
+                    Batch.project_id == project_id
+                )
+            )
+            if active_batch is not None and batch_expires_at(active_batch) <= datetime.datetime.now(
+                    tz=datetime.timezone.utc):
+                active_batch.is_active = False
+                active_batch = None
+
+            if active_batch is None:
+                active_batch = Batch(
+                    name="",
+                    is_active=True,
+                    project_id=project_id,
+                )
+                session.add(active_batch)
+                await session.flush()
+            active_batches.put_on_commit(session.sync_session, project_id, active_batch)
+
+        return active_batch
+
+    async def deactivate_batch(self, batch_id: int):
+        async with unit_of_work() as session:
+            active_batch = await session.get(Batch, batch_id)
+            if active_batch is None:
+                return
+            active_batch.is_active = False
+            active_batches.invalidate_on_commit(session.sync_session, batch_id)
+
+    async def get_patches_in_range(self, batch_id: int, start: datetime.datetime, end: datetime.datetime):
+        async with unit_of_work() as session:
+            db_patches = await session.scalars(
+                select(BatchProjectPatch).options(
+                    selectinload(BatchProjectPatch.patch).selectinload(ProjectPatch.patch_blob),
+                ).where(
+                    BatchProjectPatch.batch_id == batch_id,
+                    BatchProjectPatch.created_at >= start,
+                    BatchProjectPatch.created_at <= end.astimezone(datetime.timezone.utc),
+                )
+            )
+            return [db_patch.patch for db_patch in db_patches.all()]
+
+    async def clear_outputs(self, batch_id: int):
+        async with unit_of_work() as session:
+            batch = await self.get_batch(batch_id)
+            for batch_worklog in batch.worklogs:
+                await session.delete(batch_worklog.worklog)
+                await session.delete(batch_worklog)
+
+    async def get_worklogs(self, batch_id: int) -> List[Worklog]:
+        batch = await self.get_batch(batch_id)
+        if batch is None:
+            return []
+        return batch.worklogs
+
+
+    async def add_metric(self, project_id: int, entity: str, is_unique: bool,
+                         lines_added, lines_removed, lines_affected, files_affected):
+        async with unit_of_work() as session:
+            batch_id = await self.get_active_batch_id(project_id)
+            last_metrics = await self.get_last_metrics(project_id, entity, is_unique)
+
+            if last_metrics is not None and (
+                    last_metrics.added_lines == lines_added and
+                    last_metrics.removed_lines == lines_removed and
+                    last_metrics.affected_lines == lines_affected and
+                    last_metrics.affected_files == files_affected):
+                return
+
+            db_metrics = BatchCodeMetrics(
+                created_at=datetime.datetime.now(tz=datetime.timezone.utc).replace(microsecond=0),
+                entity=entity,
+                is_unique=is_unique,
+
+                batch_id=batch_id,
+                added_lines=lines_added,
+                removed_lines=lines_removed,
+                affected_lines=lines_affected,
+                affected_files=files_affected,
+
+                delta_added_lines=lines_added if last_metrics is None else lines_added - last_metrics.added_lines,
+                delta_removed_lines=lines_removed if last_metrics is None else
+                lines_removed - last_metrics.removed_lines,
+                delta_affected_lines=lines_affected if last_metrics is None else
+                lines_affected - last_metrics.affected_lines,
+                delta_affected_files=files_affected if last_metrics is None else
+                files_affected - last_metrics.affected_files,
+            )
+            session.add(db_metrics)
+            await self.append_time_rollup(db_metrics)
+
+    async def append_time_rollup(self, metrics: BatchCodeMetrics):
+        if not is_time_reported(metrics):
+            return
+        async with unit_of_work() as session:
+            await session.flush()
+            previous = await session.scalar(
+                select(BatchTimeRollup).where(
+                    BatchTimeRollup.batch_id == metrics.batch_id,
+                ).order_by(desc(BatchTimeRollup.created_at)).limit(1)
+            )
+            if previous is None:
+                await session.execute(text(TIME_ROLLUP_SQL), {'batch_id': metrics.batch_id})
+                return
+            session.add(build_time_rollup(metrics, previous))
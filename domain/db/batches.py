@@ -1,14 +1,146 @@
 import datetime
-from typing import List, Tuple
+import threading
+from typing import Dict, List, Set, Tuple
 
-from sqlalchemy import desc, text
+from sqlalchemy import desc, event, func, text, select, literal, union_all
+from sqlalchemy.orm import Session, selectinload
 
-from models import SessionLocal, Batch, BatchWorklog, BatchProjectPatch, BatchProjectCommit, Worklog, BatchCodeMetrics
+from domain.db.unit_of_work import commit_or_flush, transaction
+from domain.patch_codec import patch_codec
+from domain.patch_snapshots import PatchState, append_snapshot, encode_snapshot, next_snapshot, patch_states, \
+    rebuild_state, split_patch
+from models import ScopedSession, Project, Batch, BatchWorklog, BatchProjectPatch, BatchProjectCommit, Worklog, \
+    BatchCodeMetrics, BatchMetricsSnapshot, ProjectPatch, ProjectCommit, BatchTimeRollup, PatchBlob, BatchPatchSnapshot
 
-session = SessionLocal()
+session = ScopedSession
 
 PatchMetricsVersion = 2
 
+# builds the rollup rows of a batch from its metrics log, every row is compared with the previous one by LAG
+TIME_ROLLUP_SQL = '''
+INSERT INTO batch_time_rollup (created_at, batch_id, metric_id, start_dt, end_dt, time_elapsed, lines_amount, efficiency)
+SELECT
+    created_at,
+    batch_id,
+    id,
+    COALESCE(date_trunc('minute', prev_created_at), date_trunc('minute', created_at) - interval '300 seconds'),
+    date_trunc('minute', created_at),
+    time_elapsed,
+    lines_amount,
+    lines_amount * 60 / time_elapsed
+FROM (
+    SELECT *, COALESCE(extract(epoch from created_at - prev_created_at), 300) as time_elapsed
+    FROM (
+        SELECT id, batch_id, created_at, delta_added_lines + delta_removed_lines as lines_amount,
+            LAG(created_at) OVER (ORDER BY created_at) as prev_created_at
+        FROM batch_code_metrics_log
+        WHERE batch_id=:batch_id and entity='patch' and is_unique and affected_lines > 0
+    ) with_previous
+) elapsed
+WHERE NOT EXISTS (SELECT 1 FROM batch_time_rollup r WHERE r.metric_id = elapsed.id);
+'''
+
+TIME_REPORT_SQL = '''
+WITH rollup as (
+    SELECT *, avg(efficiency) FILTER (WHERE time_elapsed < 1800) OVER () as average
+    FROM batch_time_rollup
+    WHERE batch_id=:batch_id
+)
+select
+    (case when r.time_elapsed <= 1800 then r.time_elapsed else ceil((r.lines_amount / r.average) / 5) * 300 end)::integer as real_time_elapsed,
+    r.time_elapsed::integer,
+    r.start_dt,
+    r.end_dt,
+    r.efficiency::float,
+    am.*,
+    date_trunc('minute', am.created_at) as dt,
+    am.delta_added_lines + am.delta_removed_lines as lines_amount,
+    r.average::float
+
+from rollup r
+join batch_code_metrics_log am on am.id = r.metric_id
+order by r.start_dt;
+'''
+
+
+def is_time_reported(metrics: BatchCodeMetrics) -> bool:
+    return metrics.entity == 'patch' and metrics.is_unique and metrics.affected_lines > 0
+
+
+def build_time_rollup(metrics: BatchCodeMetrics, previous: BatchTimeRollup) -> BatchTimeRollup:
+    # the same numbers TIME_ROLLUP_SQL gives for a row which has a previous one
+    time_elapsed = (metrics.created_at - previous.created_at).total_seconds()
+    lines_amount = metrics.delta_added_lines + metrics.delta_removed_lines
+    return BatchTimeRollup(
+        created_at=metrics.created_at,
+        batch_id=metrics.batch_id,
+        metric_id=metrics.id,
+        start_dt=previous.created_at.replace(second=0, microsecond=0),
+        end_dt=metrics.created_at.replace(second=0, microsecond=0),
+        time_elapsed=time_elapsed,
+        lines_amount=lines_amount,
+        efficiency=lines_amount * 60 / time_elapsed,
+    )
+
+
+def batch_expires_at(batch: Batch) -> datetime.datetime:
+    # a batch is active until the end of the UTC day it was created on
+    created_at = batch.created_at.astimezone(tz=datetime.timezone.utc)
+    return created_at.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+
+
+class ActiveBatchCache:
+    """Active batch id of every project together with the moment it has to be rolled over."""
+
+    def __init__(self):
+        self.batches: Dict[int, Tuple[int, datetime.datetime]] = {}  # project id: (batch id, expires at)
+        self.lock = threading.Lock()
+
+    def get(self, project_id: int) -> int | None:
+        with self.lock:
+            cached = self.batches.get(project_id)
+            if cached is None:
+                return None
+            if cached[1] <= datetime.datetime.now(tz=datetime.timezone.utc):
+                self.batches.pop(project_id)
+                return None
+            return cached[0]
+
+    def put_on_commit(self, db_session: Session, project_id: int, batch: Batch):
+        """Caches the batch once the outermost transaction of the session commits, a rollback drops it."""
+        db_session.info.setdefault('active_batches', {})[project_id] = (batch.id, batch_expires_at(batch))
+        db_session.info.get('invalidated_batches', set()).discard(batch.id)
+
+    def invalidate_on_commit(self, db_session: Session, batch_id: int):
+        """Drops the batch from the cache once the outermost transaction of the session commits."""
+        db_session.info.setdefault('invalidated_batches', set()).add(batch_id)
+        pending = db_session.info.get('active_batches', {})
+        for project_id, cached in list(pending.items()):
+            if cached[0] == batch_id:
+                pending.pop(project_id)
+
+    def apply_committed(self, batches: Dict[int, Tuple[int, datetime.datetime]], invalidated: Set[int]):
+        with self.lock:
+            self.batches.update(batches)
+            for project_id, cached in list(self.batches.items()):
+                if cached[0] in invalidated:
+                    self.batches.pop(project_id)
+
+
+active_batches = ActiveBatchCache()
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_committed_batches(db_session: Session):
+    active_batches.apply_committed(db_session.info.pop('active_batches', {}),
+                                   db_session.info.pop('invalidated_batches', set()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_rolled_back_batches(db_session: Session):
+    db_session.info.pop('active_batches', None)
+    db_session.info.pop('invalidated_batches', None)
+
 
 class Batches:
     def __init__(self):
@@ -23,19 +155,56 @@ class Batches:
         )
 
     def update_current_patch(self, project_id: int, patch: str, branch: str):
+        """Appends the files of the patch which changed since the last call to the snapshot log of the active batch."""
         batch = self.get_active_batch(project_id)
-        batch.last_patch = patch
+        state = self.get_patch_state(batch)
         batch.last_branch = branch
-        session.commit()
+        change = next_snapshot(state, split_patch(patch))
+        if change is not None:
+            is_base, snapshot = change
+            dictionary_id, size, data = encode_snapshot(snapshot)
+            db_snapshot = BatchPatchSnapshot(batch_id=batch.id, is_base=is_base, dictionary_id=dictionary_id,
+                                             size=size, data=data)
+            session.add(db_snapshot)
+            session.flush()
+            if is_base:
+                # compaction, the new base holds everything the older rows did
+                session.query(BatchPatchSnapshot).filter(
+                    BatchPatchSnapshot.batch_id == batch.id,
+                    BatchPatchSnapshot.id < db_snapshot.id,
+                ).delete()
+                batch.last_patch = None
+            patch_states.put(project_id, append_snapshot(state, db_snapshot.id, is_base, snapshot, data))
+        commit_or_flush(session)
 
     def get_current_patch(self, project_id: int) -> Tuple[str, str]:
         batch = self.get_active_batch(project_id)
-        return batch.last_patch, batch.last_branch
+        return self.get_patch_state(batch).to_string(), batch.last_branch
+
+    def get_patch_state(self, batch: Batch) -> PatchState:
+        last_row_id = session.query(func.max(BatchPatchSnapshot.id)).filter(
+            BatchPatchSnapshot.batch_id == batch.id
+        ).scalar()
+        if last_row_id is None:
+            # a batch saved before the snapshot log keeps its whole patch in the batch row
+            return PatchState(batch_id=batch.id, files=split_patch(batch.last_patch))
+        state = patch_states.get(batch.project_id, batch.id, last_row_id)
+        if state is None:
+            base_row_id = session.query(func.max(BatchPatchSnapshot.id)).filter(
+                BatchPatchSnapshot.batch_id == batch.id,
+                BatchPatchSnapshot.is_base == True,
+            ).scalar()
+            state = rebuild_state(batch.id, session.query(BatchPatchSnapshot).filter(
+                BatchPatchSnapshot.batch_id == batch.id,
+                BatchPatchSnapshot.id >= base_row_id,
+            ).order_by(BatchPatchSnapshot.id).all())
+            patch_states.put(batch.project_id, state)
+        return state
 
     def get_last_metrics(self, project_id: int, entity: str, is_unique: bool) -> BatchCodeMetrics | None:
-        batch = self.get_active_batch(project_id)
+        batch_id = self.get_active_batch_id(project_id)
         return session.query(BatchCodeMetrics).filter(
-            BatchCodeMetrics.batch_id == batch.id,
+            BatchCodeMetrics.batch_id == batch_id,
             BatchCodeMetrics.entity == entity,
             BatchCodeMetrics.is_unique == is_unique,
         ).order_by(
@@ -48,30 +217,47 @@ class Batches:
             Batch.project_id == project_id
         ).all()
 
-    def get_active_batch(self, project_id: int) -> Batch:
-        active_batch = (
-            session.query(Batch)
-            .filter(
-                Batch.is_active == True,
-                Batch.project_id == project_id
-            ).one_or_none()
-        )
-        batch_too_old = False
-        if active_batch is not None:
-            batch_day = active_batch.created_at.astimezone(tz=datetime.timezone.utc).day
-            today = datetime.datetime.now(tz=datetime.timezone.utc).day
-            batch_too_old = batch_day != today
-            if batch_too_old:
-                self.deactivate_batch(active_batch.id)
+    def get_active_batch_id(self, project_id: int) -> int:
+        batch_id = active_batches.get(project_id)
+        if batch_id is None:
+            batch_id = self.roll_active_batch(project_id).id
+        return batch_id
 
-        if active_batch is None:
-            active_batch = Batch(
-                name="",
-                is_active=True,
-                project_id=project_id,
+    def get_active_batch(self, project_id: int) -> Batch:
+        batch_id = active_batches.get(project_id)
+        if batch_id is not None:
+            active_batch = session.get(Batch, batch_id)
+            if active_batch is not None:
+                return active_batch
+        return self.roll_active_batch(project_id)
+
+    def roll_active_batch(self, project_id: int) -> Batch:
+        with transaction():
+            # the project row lock makes concurrent rollovers of the project wait for each other,
+            # the one coming second finds the new batch already created
+            session.query(Project.id).filter(Project.id == project_id).with_for_update().one()
+            active_batch = (
+                session.query(Batch)
+                .filter(
+                    Batch.is_active == True,
+                    Batch.project_id == project_id
+                ).one_or_none()
             )
-            session.add(active_batch)
-            session.commit()
+            if active_batch is not None and batch_expires_at(active_batch) <= datetime.datetime.now(
+                    tz=datetime.timezone.utc):
+                active_batch.is_active = False
+                active_batch = None
+
+            if active_batch is None:
+                active_batch = Batch(
+                    name="",
+                    is_active=True,
+                    project_id=project_id,
+                )
+                session.add(active_batch)
+                session.flush()
+            # a nested transaction() only flushes, the id is cached when the outer one commits
+            active_batches.put_on_commit(session, project_id, active_batch)
 
         return active_batch
 
@@ -80,11 +266,14 @@ class Batches:
         if active_batch is None:
             return
         active_batch.is_active = False
-        session.commit()
+        active_batches.invalidate_on_commit(session, batch_id)
+        commit_or_flush(session)
 
     def get_patches_in_range(self, batch_id: int, start: datetime.datetime, end: datetime.datetime):
         result = []
-        db_patches = session.query(BatchProjectPatch).filter(
+        db_patches = session.query(BatchProjectPatch).options(
+            selectinload(BatchProjectPatch.patch).selectinload(ProjectPatch.patch_blob),
+        ).filter(
             BatchProjectPatch.batch_id == batch_id,
             BatchProjectPatch.created_at >= start,
             BatchProjectPatch.created_at <= end.astimezone(datetime.timezone.utc),
@@ -98,7 +287,7 @@ class Batches:
         for batch_worklog in batch.worklogs:
             session.delete(batch_worklog.worklog)
             session.delete(batch_worklog)
-        session.commit()
+        commit_or_flush(session)
 
     def add_worklog(self, batch_id: int, worklog_id: int):
         bw = BatchWorklog(
@@ -106,7 +295,7 @@ class Batches:
             worklog_id=worklog_id,
         )
         session.add(bw)
-        session.commit()
+        commit_or_flush(session)
 
     def get_worklogs(self, batch_id: int) -> List[Worklog]:
         batch = self.get_batch(batch_id)
@@ -120,7 +309,11 @@ class Batches:
             patch_id=patch_id,
         )
         session.add(bw)
-        session.commit()
+        commit_or_flush(session)
+
+    def add_patches(self, batch_id: int, patch_ids: List[int]):
+        session.add_all([BatchProjectPatch(batch_id=batch_id, patch_id=patch_id) for patch_id in patch_ids])
+        commit_or_flush(session)
 
     def add_commit(self, batch_id: int, commit_id: int):
         bw = BatchProjectCommit(
@@ -128,11 +321,73 @@ class Batches:
             commit_id=commit_id,
         )
         session.add(bw)
-        session.commit()
+        commit_or_flush(session)
+
+    def add_commits(self, batch_id: int, commit_ids: List[int]):
+        session.add_all([BatchProjectCommit(batch_id=batch_id, commit_id=commit_id) for commit_id in commit_ids])
+        commit_or_flush(session)
+
+    def add_worklogs(self, batch_id: int, worklog_ids: List[int]):
+        session.add_all([BatchWorklog(batch_id=batch_id, worklog_id=worklog_id) for worklog_id in worklog_ids])
+        commit_or_flush(session)
+
+    def get_rows_after(self, batch_id: int, last_row_ids: Dict[str, int]) -> List[Tuple[str, int, str]]:
+        """Patch texts linked to the batch after the given link row ids, as (entity, link row id, text),
+        `patch` and `commit` entities are read by one query."""
+        queries = []
+        if 'patch' in last_row_ids:
+            queries.append(
+                select(
+                    literal('patch').label('entity'), BatchProjectPatch.id, PatchBlob.dictionary_id, PatchBlob.data
+                ).join(
+                    ProjectPatch, ProjectPatch.id == BatchProjectPatch.patch_id
+                ).join(
+                    PatchBlob, PatchBlob.hash == ProjectPatch.patch_hash
+                ).where(
+                    BatchProjectPatch.batch_id == batch_id,
+                    BatchProjectPatch.id > last_row_ids['patch'],
+                )
+            )
+        if 'commit' in last_row_ids:
+            queries.append(
+                select(
+                    literal('commit').label('entity'), BatchProjectCommit.id, PatchBlob.dictionary_id, PatchBlob.data
+                ).join(
+                    ProjectCommit, ProjectCommit.id == BatchProjectCommit.commit_id
+                ).join(
+                    PatchBlob, PatchBlob.hash == ProjectCommit.patch_hash
+                ).where(
+                    BatchProjectCommit.batch_id == batch_id,
+                    BatchProjectCommit.id > last_row_ids['commit'],
+                )
+            )
+        if len(queries) == 0:
+            return []
+        query = union_all(*queries).subquery()
+        return [
+            (row.entity, row.id, patch_codec.decompress(row.dictionary_id, row.data))
+            for row in session.execute(select(query).order_by(query.c.entity, query.c.id)).all()
+        ]
+
+    def get_metrics_snapshot(self, batch_id: int, entity: str) -> BatchMetricsSnapshot | None:
+        return session.query(BatchMetricsSnapshot).filter(
+            BatchMetricsSnapshot.batch_id == batch_id,
+            BatchMetricsSnapshot.entity == entity,
+        ).one_or_none()
+
+    def save_metrics_snapshot(self, batch_id: int, entity: str, last_row_id: int, snapshot: bytes):
+        db_snapshot = self.get_metrics_snapshot(batch_id, entity)
+        if db_snapshot is None:
+            db_snapshot = BatchMetricsSnapshot(batch_id=batch_id, entity=entity)
+            session.add(db_snapshot)
+        db_snapshot.created_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        db_snapshot.last_row_id = last_row_id
+        db_snapshot.snapshot = snapshot
+        commit_or_flush(session)
 
     def add_metric(self, project_id: int, entity: str, is_unique: bool,
                    lines_added, lines_removed, lines_affected, files_affected):
-        batch = self.get_active_batch(project_id)
+        batch_id = self.get_active_batch_id(project_id)
         last_metrics = self.get_last_metrics(project_id, entity, is_unique)
 
         if last_metrics is None:
@@ -141,7 +396,7 @@ class Batches:
                 entity=entity,
                 is_unique=is_unique,
 
-                batch_id=batch.id,
+                batch_id=batch_id,
                 added_lines=lines_added,
                 removed_lines=lines_removed,
                 affected_lines=lines_affected,
@@ -153,7 +408,8 @@ class Batches:
                 delta_affected_files=files_affected,
             )
             session.add(last_metrics)
-            session.commit()
+            self.append_time_rollup(last_metrics)
+            commit_or_flush(session)
             return
 
         if (last_metrics.added_lines == lines_added and
@@ -167,7 +423,7 @@ class Batches:
             entity=entity,
             is_unique=is_unique,
 
-            batch_id=batch.id,
+            batch_id=batch_id,
             added_lines=lines_added,
             removed_lines=lines_removed,
             affected_lines=lines_affected,
@@ -179,65 +435,29 @@ class Batches:
             delta_affected_files=0 if last_metrics is None else files_affected - last_metrics.affected_files,
         )
         session.add(db_metrics)
-        session.commit()
+        self.append_time_rollup(db_metrics)
+        commit_or_flush(session)
+
+    def append_time_rollup(self, metrics: BatchCodeMetrics):
+        if not is_time_reported(metrics):
+            return
+        session.flush()
+        previous = session.query(BatchTimeRollup).filter(
+            BatchTimeRollup.batch_id == metrics.batch_id,
+        ).order_by(desc(BatchTimeRollup.created_at)).limit(1).one_or_none()
+        if previous is None:
+            # the first row of the batch, or a batch logged before the rollup existed
+            session.execute(text(TIME_ROLLUP_SQL), {'batch_id': metrics.batch_id})
+            return
+        session.add(build_time_rollup(metrics, previous))
 
     def get_time_report(self, batch_id: int):
-        report_sql = '''
-        WITH all_metrics as (
-    SELECT *, date_trunc('minute', created_at) as dt, delta_added_lines + delta_removed_lines as lines_amount
-    from batch_code_metrics_log
-    where batch_id=:batch_id and entity='patch' and is_unique and affected_lines > 0
-),
-all_metric_headers as (
-    SELECT
-        id, date_trunc('second', created_at) as dt
-    from
-        all_metrics
-),
-previous_metrics as (
-    SELECT id,
-        date_trunc('minute', created_at) as dt,
-        (
-            select id
-            from all_metric_headers
-            where all_metric_headers.dt < date_trunc('second', created_at)
-            order by all_metric_headers.dt desc
-            limit 1
-         ) as prev_id
-    from all_metrics
-),
-elapsed_estimation as (
-    SELECT am.id,
-        COALESCE(am2.dt, am.dt - interval '300 seconds') as start_dt,
-        am.dt as end_dt,
-        am.created_at,
-        COALESCE(pg_catalog.extract('epoch', am.created_at - am2.created_at), 300) as time_elapsed,
-        am.lines_amount
-    FROM previous_metrics pm
-    left join all_metrics am on pm.id = am.id
-    left join all_metrics am2 on pm.prev_id = am2.id
-),
-average_estimation as (
-    SELECT avg(am.lines_amount * 60 / time_elapsed) as average
-    FROM elapsed_estimation ee
-    left join all_metrics am on ee.id = am.id
-    WHERE time_elapsed < 1800
-)
-select
-    (case when ee.time_elapsed <= 1800 then ee.time_elapsed else ceil((am.lines_amount / ae.average) / 5) * 300 end)::integer as real_time_elapsed,
-    ee.time_elapsed::integer,
-    ee.start_dt,
-    ee.end_dt,
-    (am.lines_amount*60/ee.time_elapsed)::float as efficiency,
-    am.*,
-    ae.average::float
+        has_rollup = session.query(BatchTimeRollup.id).filter(BatchTimeRollup.batch_id == batch_id).first()
+        if has_rollup is None:
+            session.execute(text(TIME_ROLLUP_SQL), {'batch_id': batch_id})
+            commit_or_flush(session)
 
-from all_metrics am
-left join elapsed_estimation ee on am.id=ee.id
-left join average_estimation ae on true
-order by ee.start_dt;
-'''
-        result = session.execute(text(report_sql), {'batch_id': batch_id})
+        result = session.execute(text(TIME_REPORT_SQL), {'batch_id': batch_id})
         rows = result.all()
 
         dict_result = []
@@ -0,0 +1,68 @@
+import contextlib
+import threading
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import AsyncSessionLocal, ScopedSession
+
+_current_session: ContextVar[AsyncSession | None] = ContextVar('current_session', default=None)
+_transactions = threading.local()
+
+
+@contextlib.contextmanager
+def transaction() -> Iterator[Session]:
+    """Sync unit of work on the thread's scoped session: one commit when the outermost block exits.
+
+    Nested blocks only flush, so their ids are available while the outer block goes on.
+    """
+    session = ScopedSession()
+    depth = getattr(_transactions, 'depth', 0)
+    _transactions.depth = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+        else:
+            session.flush()
+    except BaseException:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        _transactions.depth = depth
+
+
+def commit_or_flush(session: Session):
+    """Commits right away unless a transaction() block is open on this thread, then it only flushes."""
+    if getattr(_transactions, 'depth', 0) > 0:
+        session.flush()
+    else:
+        session.commit()
+
+
+@contextlib.asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """Async session committed once when the block exits and rolled back if it raises.
+
+    Nested units of work of the same task join the outer one, so a repository function called
+    from another one does not commit on its own.
+    """
+    session = _current_session.get()
+    if session is not None:
+        yield session
+        return
+
+    session = AsyncSessionLocal()
+    token = _current_session.set(session)
+    try:
+        yield session
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        _current_session.reset(token)
+        await session.close()
@@ -1,31 +1,72 @@
-import difflib
 import re
-from copy import deepcopy
-from typing import List, Dict, Tuple
+from array import array
+from collections.abc import MutableMapping
+from typing import List, Dict, Tuple, Iterator
+
+_LINE_MARKS = "-+@ ?"
+_CONTEXT, _REMOVE, _ADD, _UNKNOWN = b' -+?'
+_HEADER_LINE = re.compile(r'^(?:diff|---|\+\+\+|@@|index )', re.M)
+_ADDED_LINE = re.compile(r'^\+(?!\+\+)(.*)', re.M)
+_REMOVED_LINE = re.compile(r'^-(?!--)(.*)', re.M)
 
 
 class DiffChunk:
-    def __init__(self, header: str):
-        header_data = self._parse_header(header)
-        try:
-            self.ost = int(header_data[0])
-            self.oln = int(header_data[1] if header_data[1] != '' else int(header_data[0]))
-            self.nst = int(header_data[2])
-            self.nln = int(header_data[3] if header_data[3] != '' else int(header_data[2]))
-        except Exception as e:
-            print(header, header_data)
-            raise ValueError
+    """Hunk of a FilePatch: a view over its header fields and line opcodes, the lines stay in the patch text."""
+
+    __slots__ = ('file_patch', 'index')
+
+    def __init__(self, file_patch: 'FilePatch', index: int):
+        self.file_patch = file_patch
+        self.index = index
+
+    @property
+    def ost(self) -> int:
+        return self.file_patch.headers[4 * self.index]
+
+    @property
+    def oln(self) -> int:
+        return self.file_patch.headers[4 * self.index + 1]
+
+    @property
+    def nst(self) -> int:
+        return self.file_patch.headers[4 * self.index + 2]
+
+    @property
+    def nln(self) -> int:
+        return self.file_patch.headers[4 * self.index + 3]
+
+    @property
+    def original_start(self) -> int:
+        return self.ost - 1 if self.ost > 0 else 0
 
-        self.original_start = self.ost - 1 if self.ost > 0 else 0
-        self.original_length = self.oln
+    @property
+    def original_length(self) -> int:
+        return self.oln
 
-        self.new_start = self.nst - 1 if self.nst > 0 else 0
-        self.new_length = self.nln
+    @property
+    def new_start(self) -> int:
+        return self.nst - 1 if self.nst > 0 else 0
 
-        self.original_last_line = self.original_start + self.oln if self.oln > 0 else 0
-        self.new_last_line = self.new_start + self.nln if self.nln > 0 else 0
+    @property
+    def new_length(self) -> int:
+        return self.nln
 
-        self.lines = []
+    @property
+    def original_last_line(self) -> int:
+        return self.original_start + self.oln if self.oln > 0 else 0
+
+    @property
+    def new_last_line(self) -> int:
+        return self.new_start + self.nln if self.nln > 0 else 0
+
+    @property
+    def lines(self) -> List[str]:
+        return [self.file_patch.line(i) for i in self.line_range()]
+
+    def line_range(self) -> range:
+        hunk_lines = self.file_patch.hunk_lines
+        last = hunk_lines[self.index + 1] if self.index + 1 < len(hunk_lines) else len(self.file_patch.ops)
+        return range(hunk_lines[self.index], last)
 
     def to_string(self) -> str:
         return ''.join(self.lines)
@@ -34,12 +75,6 @@ class DiffChunk:
         header = f"@@ -{self.ost},{self.oln} +{self.nst},{self.nln} @@\n"
         return header + ''.join(self.lines)
 
-    def _parse_header(self, header: str):
-        m = re.match(r"^@@ -(\d+),?(\d*) \+(\d+),?(\d*) @@$", header)
-        if not m:
-            raise ValueError("Invalid patch string: " + header)
-        return m.group(1), m.group(2), m.group(3), m.group(4)
-
     def apply(self, original_lines: List[str]):
         result = []
 
@@ -48,26 +83,28 @@ class DiffChunk:
         if original_len != self.original_length:
             print('Bad lines amount')
 
+        file_patch = self.file_patch
+        ops = file_patch.ops
         i = 0
-        for line in self.lines:
-            op = line[0]
-            text = line[1:]
+        for line_index in self.line_range():
+            op = ops[line_index]
 
-            if op == " ":
+            if op == _CONTEXT:
+                text = file_patch.line_body(line_index)
                 if text.strip(' \r\n\t') == original_lines[i].strip(' \r\n\t'):
                     result.append(original_lines[i])
                     i = i + 1
                 else:
                     print("lines do not match for copy")
 
-            elif op == "-":
-                if text == original_lines[i]:
+            elif op == _REMOVE:
+                if file_patch.line_body(line_index) == original_lines[i]:
                     i = i + 1
                 else:
                     print("lines do not match for removal")
 
-            elif op == "+":
-                result.append(text)
+            elif op == _ADD:
+                result.append(file_patch.line_body(line_index))
 
         if len(result) != self.new_length:
             print('Bad result lines amount')
@@ -79,29 +116,28 @@ class DiffChunk:
         if len(new_lines) != self.new_length:
             print('Bad lines amount')
 
+        file_patch = self.file_patch
+        ops = file_patch.ops
         i = 0
-        for line in self.lines:
-            op = line[0]
-            text = line[1:]
+        for line_index in self.line_range():
+            op = ops[line_index]
 
-            if op == " ":
+            if op == _CONTEXT:
+                text = file_patch.line_body(line_index)
                 if text.strip(' \r\n\t') == new_lines[i].strip(' \r\n\t'):
                     result.append(new_lines[i])
                     i = i + 1
                 else:
                     print("lines do not match for copy")
 
-            elif op == "-":
-                # if text == new_lines[i]:
-                result.append(text)
-                # else:
-                #     print("lines do not match for removal")
+            elif op == _REMOVE:
+                result.append(file_patch.line_body(line_index))
 
-            elif op == "+" or op == "?":
+            elif op == _ADD or op == _UNKNOWN:
                 i = i + 1
 
             else:
-                result.append(text)
+                result.append(file_patch.line_body(line_index))
                 i = i + 1
 
         if len(result) != self.original_length:
@@ -111,13 +147,47 @@ class DiffChunk:
 
 
 class FilePatch:
-    def __init__(self):
-        self.lines: List[str] = []
+    """Parsed diff of a single file, kept compact: hunk headers are packed by four ints into `headers`,
+    hunk lines are opcodes (their first character) in `ops` plus their offsets in the shared patch text.
+    `hunk_lines` holds the index of the first line of every hunk."""
+
+    __slots__ = ('text', 'original_file', 'new_file', 'is_deleted', 'is_new', 'original_blob', 'new_blob',
+                 'headers', 'hunk_lines', 'ops', 'offsets')
+
+    def __init__(self, text: str = ''):
+        self.text = text
         self.original_file: str = None
         self.new_file: str = None
         self.is_deleted: bool = False
         self.is_new: bool = False
-        self.chunks: List[DiffChunk] = []
+        self.original_blob: str | None = None
+        self.new_blob: str | None = None
+        self.headers = array('i')
+        self.hunk_lines = array('i')
+        self.ops = bytearray()
+        self.offsets = array('q')
+
+    @property
+    def chunks(self) -> List[DiffChunk]:
+        return [DiffChunk(self, index) for index in range(len(self.hunk_lines))]
+
+    def add_hunk(self, header: str):
+        self.headers.extend(_parse_hunk_header(header))
+        self.hunk_lines.append(len(self.ops))
+
+    def add_line(self, offset: int):
+        self.ops.append(ord(self.text[offset]))
+        self.offsets.append(offset)
+
+    def line(self, index: int) -> str:
+        start = self.offsets[index]
+        end = self.text.find('\n', start)
+        return self.text[start:end + 1 if end != -1 else len(self.text)]
+
+    def line_body(self, index: int) -> str:
+        start = self.offsets[index] + 1
+        end = self.text.find('\n', start)
+        return self.text[start:end + 1 if end != -1 else len(self.text)]
 
     def file_name(self) -> str:
         if self.is_new:
@@ -137,7 +207,10 @@ class FilePatch:
         a_name = a_name.removeprefix('/')
         b_name = b_name.removeprefix('/')
 
-        header = f"diff --git a/{a_name} b/{b_name}\n--- a/{a_name}\n+++ b/{b_name}\n"
+        header = f"diff --git a/{a_name} b/{b_name}\n"
+        if self.original_blob is not None and self.new_blob is not None:
+            header += f"index {self.original_blob}..{self.new_blob}\n"
+        header += f"--- a/{a_name}\n+++ b/{b_name}\n"
         chunks = [chunk.to_full_string() for chunk in self.chunks]
         return header + ''.join(chunks)
 
@@ -148,33 +221,17 @@ class FilePatch:
             return self.original_file
         return self.new_file
 
-    def scan_chunks(self):
-        current_chunk = None
-        for line in self.lines:
-            if line.startswith("@@"):
-                current_chunk = DiffChunk(line)
-                self.chunks.append(current_chunk)
-            else:
-                current_chunk.lines.append(line)
-
-    def process(self):
-        if self.new_file.startswith('+++'):
-            self.new_file = self.new_file[4:].strip('\n')
-            if self.new_file.startswith('b/'):
-                self.new_file = self.new_file[2:]
-        if self.original_file.startswith('---'):
-            self.original_file = self.original_file[4:].strip('\n')
-            if self.original_file.startswith('a/'):
-                self.original_file = self.original_file[2:]
+    def process_names(self):
+        self.new_file = _header_path(self.new_file, '+++', 'b/')
+        self.original_file = _header_path(self.original_file, '---', 'a/')
         if self.original_file == '/dev/null':
             self.is_new = True
         if self.new_file == '/dev/null':
             self.is_deleted = True
-        self.scan_chunks()
 
     def apply(self, text: List[str]) -> List[str]:
         if len(self.chunks) == 0:
-            return deepcopy(text)
+            return list(text)
         result = []
 
         prev_chunk_end = 0
@@ -182,8 +239,7 @@ class FilePatch:
             if prev_chunk_end < chunk.original_start:
                 result.extend(text[prev_chunk_end:chunk.original_start])
 
-            lines_to_apply = deepcopy(text[chunk.original_start:chunk.original_last_line]) \
-                if chunk.original_length > 0 else []
+            lines_to_apply = text[chunk.original_start:chunk.original_last_line] if chunk.original_length > 0 else []
             applied_lines = chunk.apply(lines_to_apply)
 
             result.extend(applied_lines)
@@ -195,13 +251,13 @@ class FilePatch:
 
     def revert(self, text: List[str]) -> List[str]:
         if len(self.chunks) == 0:
-            return deepcopy(text)
+            return list(text)
         result = []
 
         prev_chunk_end = 0
         for chunk in self.chunks:
             result.extend(text[prev_chunk_end:chunk.new_start])
-            applied_lines = chunk.revert(deepcopy(text[chunk.new_start:chunk.new_last_line]))
+            applied_lines = chunk.revert(text[chunk.new_start:chunk.new_last_line])
             result.extend(applied_lines)
             prev_chunk_end = chunk.new_last_line
 
@@ -211,112 +267,236 @@ class FilePatch:
         return result
 
 
+class FileSection:
+    """Location of a single file diff inside the patch text.
+
+    `start`/`end` delimit the whole `diff ...` section, `hunks` holds the offset of every `@@` header line.
+    """
+
+    __slots__ = ('start', 'end', 'original_file', 'new_file', 'original_blob', 'new_blob', 'hunks')
+
+    def __init__(self, start: int):
+        self.start = start
+        self.end = start
+        self.original_file: str | None = None
+        self.new_file: str | None = None
+        self.original_blob: str | None = None
+        self.new_blob: str | None = None
+        self.hunks: List[int] = []
+
+    def file_name(self) -> str | None:
+        if self.original_file is None or self.new_file is None:
+            return None
+        original_file = _header_path(self.original_file, '---', 'a/')
+        new_file = _header_path(self.new_file, '+++', 'b/')
+        if original_file == '/dev/null':
+            return new_file
+        if new_file == '/dev/null':
+            return original_file
+        return new_file
+
+
+class FileDiffs(MutableMapping):
+    """File name -> FilePatch mapping which parses a file section only when it is read for the first time."""
+
+    def __init__(self, text: str = '', sections: Dict[str, FileSection] | None = None):
+        self._text = text
+        self._items: Dict[str, FileSection | FilePatch] = dict(sections) if sections is not None else {}
+        self.frozen = False
+
+    def __getitem__(self, key: str) -> FilePatch:
+        item = self._items[key]
+        if isinstance(item, FileSection):
+            item = self._materialize(item)
+            self._items[key] = item
+        return item
+
+    def __setitem__(self, key: str, value: FilePatch):
+        if self.frozen:
+            raise TypeError('diffs of a shared patch can not be changed, parse a new patch from its text')
+        self._items[key] = value
+
+    def __delitem__(self, key: str):
+        if self.frozen:
+            raise TypeError('diffs of a shared patch can not be changed, parse a new patch from its text')
+        del self._items[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _materialize(self, section: FileSection) -> FilePatch:
+        text = self._text
+        file_patch = FilePatch(text)
+        file_patch.original_file = section.original_file
+        file_patch.new_file = section.new_file
+        file_patch.original_blob = section.original_blob
+        file_patch.new_blob = section.new_blob
+        file_patch.process_names()
+
+        hunk_ends = section.hunks[1:] + [section.end]
+        for hunk_start, hunk_end in zip(section.hunks, hunk_ends):
+            pos = hunk_start
+            has_header = False
+            while pos < hunk_end:
+                line_end = text.find('\n', pos, hunk_end)
+                line_end = hunk_end if line_end == -1 else line_end + 1
+                if text[pos] in _LINE_MARKS and not text.startswith('---', pos, line_end) \
+                        and not text.startswith('+++', pos, line_end):
+                    if has_header:
+                        file_patch.add_line(pos)
+                    else:
+                        file_patch.add_hunk(_hunk_header(text[pos:line_end]))
+                        has_header = True
+                pos = line_end
+        return file_patch
+
+
 class Patch:
-    def __init__(self, patch: List[str] | str, is_empty=False):
+    def __init__(self, patch: List[str] | str | memoryview, is_empty=False):
+        self._changes: Tuple[Tuple[str, ...], Tuple[str, ...]] | None = None
         if is_empty:
-            self.diffs = {}
-            self._patch_text = ''
+            self._text = ''
+            self._sections = {}
+            self.diffs = FileDiffs()
             return
         if isinstance(patch, str):
-            self._patch_text = patch.splitlines(keepends=True)
+            self._text = patch
+        elif isinstance(patch, (memoryview, bytes, bytearray)):
+            self._text = str(patch, 'utf-8')
         else:
-            self._patch_text = deepcopy(patch)
+            self._text = ''.join(patch)
 
-        self.diffs: Dict[str, FilePatch] = self._parse_diffs(self._patch_text)
+        self._sections: Dict[str, FileSection] = self._scan_sections(self._text)
+        self.diffs: FileDiffs = FileDiffs(self._text, self._sections)
 
     def get_files_with_extensions_only(self, extensions: List[str]) -> 'Patch':
         result = Patch([], True)
-        for key, file_diff in self.diffs.items():
-            filename = file_diff.filename()
+        for key in self.diffs:
             should_add = False
             for ext in extensions:
-                if filename.endswith(ext):
+                if key.endswith(ext):
                     should_add = True
                     break
             if should_add:
-                result.diffs[key] = deepcopy(file_diff)
+                # file patches are never changed once parsed, the filtered patch shares them
+                result.diffs[key] = self.diffs[key]
 
         result_patch = [file_diff.to_full_string() for key, file_diff in result.get_diffs().items()]
-        result._patch_text = ''.join(result_patch)
+        result._text = ''.join(result_patch)
+        result._sections = self._scan_sections(result._text)
+
+        return result
 
+    def freeze(self) -> 'Patch':
+        self.diffs.frozen = True
+        return self
+
+    def copy(self) -> 'Patch':
+        # file sections are never changed after the scan, the copy shares them and parses files again on demand
+        result = Patch([], True)
+        result._text = self._text
+        result._sections = self._sections
+        result.diffs = FileDiffs(self._text, self._sections)
         return result
 
     def to_string(self) -> str:
-        return ''.join(self._patch_text)
+        return self._text
 
-    def get_diffs(self) -> Dict[str, FilePatch]:
+    def get_diffs(self) -> FileDiffs:
         return self.diffs
 
-    def _parse_diffs(self, patch: List[str]) -> Dict[str, FilePatch]:
-        files = []
-        current_file = None
-
-        for line in patch:
-            first_symbol = line[0]
-            if first_symbol in ["-", "+", "@", " ", "?"]:
-                if line.startswith("---"):
-                    if current_file is None:
-                        current_file = FilePatch()
-                        files.append(current_file)
-                    current_file.original_file = line
-                elif line.startswith("+++"):
-                    if current_file is None:
-                        current_file = FilePatch()
-                        files.append(current_file)
-                    current_file.new_file = line
-                else:
-                    if line.startswith("@@"):
-                        end = line.find('@@', 2)
-                        if len(line.strip('\n')) <= end + 2:
-                            current_file.lines.append(line.strip('\n'))
-                        else:
-                            current_file.lines.append(line[:end + 2])
-                    else:
-                        current_file.lines.append(line)
+    def get_file_texts(self) -> Dict[str, str]:
+        return {name: self._text[section.start:section.end] for name, section in self._sections.items()}
+
+    def _scan_sections(self, text: str) -> Dict[str, FileSection]:
+        sections = []
+        current = None
+
+        # only header lines matter here, the regex skips hunk bodies without a python level loop per line
+        for match in _HEADER_LINE.finditer(text):
+            pos = match.start()
+            line_end = text.find('\n', pos)
+            line_end = len(text) if line_end == -1 else line_end + 1
+            kind = match.group()
+
+            if kind == '---':
+                if current is None:
+                    current = FileSection(pos)
+                    sections.append(current)
+                current.original_file = text[pos:line_end]
+            elif kind == '+++':
+                if current is None:
+                    current = FileSection(pos)
+                    sections.append(current)
+                current.new_file = text[pos:line_end]
+            elif kind == 'diff':
+                if current is not None:
+                    current.end = pos
+                current = FileSection(pos)
+                sections.append(current)
+            elif current is None:
+                continue
+            elif kind == '@@':
+                current.hunks.append(pos)
             else:
-                if line.startswith('diff'):
-                    current_file = FilePatch()
-                    files.append(current_file)
+                blobs = text[pos + 6:line_end].split(' ', 1)[0].strip('\r\n').split('..')
+                if len(blobs) == 2:
+                    current.original_blob, current.new_blob = blobs
+
+        size = len(text)
+        if current is not None:
+            current.end = size
 
         result = {}
-        for f in files:
-            if len(f.lines) > 0:
-                f.process()
-                result[f.file_name()] = f
+        for section in sections:
+            name = section.file_name()
+            if name is not None and len(section.hunks) > 0:
+                result[name] = section
 
         return result
 
     def get_changes_amounts(self) -> Tuple[int, int]:
-        adds = 0
-        removals = 0
-        for line in self._patch_text:
-            if line.startswith('+') and not line.startswith('+++'):
-                adds += 1
-            if line.startswith('-') and not line.startswith('---'):
-                removals += 1
+        adds = _count_line_prefix(self._text, '+') - _count_line_prefix(self._text, '+++')
+        removals = _count_line_prefix(self._text, '-') - _count_line_prefix(self._text, '---')
         return adds, removals
 
     def get_changes(self) -> Tuple[List[str], List[str]]:
-        adds = []
-        removals = []
-        for line in self._patch_text:
-            if line.startswith('+') and not line.startswith('+++'):
-                adds.append(line.removeprefix('+').strip("\r\n\t "))
-            if line.startswith('-') and not line.startswith('---'):
-                removals.append(line.removeprefix('-').strip("\r\n\t "))
-        return adds, removals
+        if self._changes is None:
+            adds = [line.strip("\r\n\t ") for line in _ADDED_LINE.findall(self._text)]
+            removals = [line.strip("\r\n\t ") for line in _REMOVED_LINE.findall(self._text)]
+            self._changes = (tuple(adds), tuple(removals))
+        return list(self._changes[0]), list(self._changes[1])
 
     def get_metrics(self) -> dict:
         adds, rems = self.get_changes_amounts()
         return {"lines": {"added": adds, "removed": rems}}
 
 
-def compare_texts(self, text1, text2, name1, name2) -> Patch:
-    diff = difflib.unified_diff(
-        text1.splitlines(keepends=True),
-        text2.splitlines(keepends=True),
-        fromfile=name1,
-        tofile=name2,
-        lineterm=''
-    )
-    return Patch(list(diff))
+def _header_path(header: str, marker: str, prefix: str) -> str:
+    if header.startswith(marker):
+        header = header[4:].strip('\n')
+        if header.startswith(prefix):
+            header = header[2:]
+    return header
+
+
+def _parse_hunk_header(header: str) -> Tuple[int, int, int, int]:
+    m = re.match(r"^@@ -(\d+),?(\d*) \+(\d+),?(\d*) @@$", header)
+    if not m:
+        raise ValueError("Invalid patch string: " + header)
+    ost, oln, nst, nln = m.group(1), m.group(2), m.group(3), m.group(4)
+    return int(ost), int(oln if oln != '' else ost), int(nst), int(nln if nln != '' else nst)
+
+
+def _hunk_header(line: str) -> str:
+    end = line.find('@@', 2)
+    if len(line.strip('\n')) <= end + 2:
+        return line.strip('\n')
+    return line[:end + 2]
+
+
+def _count_line_prefix(text: str, prefix: str) -> int:
+    return text.count('\n' + prefix) + (1 if text.startswith(prefix) else 0)
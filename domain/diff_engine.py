@@ -0,0 +1,317 @@
+import difflib
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+Opcode = Tuple[str, int, int, int, int]
+Block = Tuple[int, int, int]  # a start, b start, size
+
+
+def intern_lines(a: Sequence[str], b: Sequence[str]) -> Tuple[List[int], List[int]]:
+    ids: Dict[str, int] = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+
+def blocks_to_opcodes(blocks: List[Block], a_length: int, b_length: int) -> List[Opcode]:
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in blocks + [(a_length, b_length, 0)]:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+
+def merge_blocks(blocks: List[Block]) -> List[Block]:
+    merged = []
+    for ai, bj, size in blocks:
+        if size == 0:
+            continue
+        if merged and merged[-1][0] + merged[-1][2] == ai and merged[-1][1] + merged[-1][2] == bj:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((ai, bj, size))
+    return merged
+
+
+class DiffEngine(ABC):
+    name = ''
+
+    @abstractmethod
+    def get_opcodes(self, a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+        pass
+
+
+class DifflibEngine(DiffEngine):
+    name = 'difflib'
+
+    def get_opcodes(self, a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+        return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+class MyersEngine(DiffEngine):
+    """Linear space Myers diff: the middle snake splits the problem in two until one side is empty."""
+
+    name = 'myers'
+
+    def get_opcodes(self, a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+        a_ids, b_ids = intern_lines(a, b)
+        return blocks_to_opcodes(self.get_blocks(a_ids, b_ids, 0, len(a_ids), 0, len(b_ids)), len(a), len(b))
+
+    def get_blocks(self, a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int) -> List[Block]:
+        blocks = []
+        stack = [(alo, ahi, blo, bhi)]
+        while stack:
+            item = stack.pop()
+            if len(item) == 3:
+                blocks.append(item)
+                continue
+            alo, ahi, blo, bhi = item
+
+            prefix = 0
+            while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+                prefix += 1
+            if prefix:
+                blocks.append((alo, blo, prefix))
+                alo += prefix
+                blo += prefix
+
+            suffix = 0
+            while alo < ahi - suffix and blo < bhi - suffix and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+                suffix += 1
+            if suffix:
+                stack.append((ahi - suffix, bhi - suffix, suffix))
+                ahi -= suffix
+                bhi -= suffix
+
+            if alo == ahi or blo == bhi:
+                continue
+            split = self.middle_snake(a, b, alo, ahi, blo, bhi)
+            if split is None:
+                continue
+            x, y = split
+            stack.append((x, ahi, y, bhi))
+            stack.append((alo, x, blo, y))
+        return merge_blocks(blocks)
+
+    def middle_snake(self, a: List[int], b: List[int], alo: int, ahi: int, blo: int,
+                     bhi: int) -> Tuple[int, int] | None:
+        n = ahi - alo
+        m = bhi - blo
+        max_d = (n + m + 1) // 2
+        offset = max_d
+        length = 2 * max_d + 2
+        forward = [-1] * length
+        backward = [-1] * length
+        forward[offset + 1] = 0
+        backward[offset + 1] = 0
+        delta = n - m
+        front = delta % 2 != 0
+        k1start = k1end = k2start = k2end = 0
+
+        for d in range(max_d):
+            for k1 in range(-d + k1start, d + 1 - k1end, 2):
+                k1_offset = offset + k1
+                if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                    x1 = forward[k1_offset + 1]
+                else:
+                    x1 = forward[k1_offset - 1] + 1
+                y1 = x1 - k1
+                while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                    x1 += 1
+                    y1 += 1
+                forward[k1_offset] = x1
+                if x1 > n:
+                    k1end += 2
+                elif y1 > m:
+                    k1start += 2
+                elif front:
+                    k2_offset = offset + delta - k1
+                    if 0 <= k2_offset < length and backward[k2_offset] != -1:
+                        if x1 >= n - backward[k2_offset]:
+                            return alo + x1, blo + y1
+
+            for k2 in range(-d + k2start, d + 1 - k2end, 2):
+                k2_offset = offset + k2
+                if k2 == -d or (k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]):
+                    x2 = backward[k2_offset + 1]
+                else:
+                    x2 = backward[k2_offset - 1] + 1
+                y2 = x2 - k2
+                while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                    x2 += 1
+                    y2 += 1
+                backward[k2_offset] = x2
+                if x2 > n:
+                    k2end += 2
+                elif y2 > m:
+                    k2start += 2
+                elif not front:
+                    k1_offset = offset + delta - k2
+                    if 0 <= k1_offset < length and forward[k1_offset] != -1:
+                        x1 = forward[k1_offset]
+                        y1 = offset + x1 - k1_offset
+                        if x1 >= n - x2:
+                            return alo + x1, blo + y1
+        return None
+
+
+class PatienceEngine(MyersEngine):
+    """Patience diff: lines unique on both sides are matched first, the gaps between them are diffed recursively,
+    and gaps without unique lines fall back to Myers."""
+
+    name = 'patience'
+
+    def get_blocks(self, a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int) -> List[Block]:
+        blocks = []
+        stack = [(alo, ahi, blo, bhi)]
+        while stack:
+            item = stack.pop()
+            if len(item) == 3:
+                blocks.append(item)
+                continue
+            alo, ahi, blo, bhi = item
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = self.unique_anchors(a, b, alo, ahi, blo, bhi)
+            if len(anchors) == 0:
+                blocks.extend(super().get_blocks(a, b, alo, ahi, blo, bhi))
+                continue
+
+            ranges = []
+            i, j = alo, blo
+            for ai, bj in anchors:
+                ranges.append((i, ai, j, bj))
+                ranges.append((ai, bj, 1))
+                i, j = ai + 1, bj + 1
+            ranges.append((i, ahi, j, bhi))
+            stack.extend(reversed(ranges))
+        return merge_blocks(blocks)
+
+    def unique_anchors(self, a: List[int], b: List[int], alo: int, ahi: int, blo: int,
+                       bhi: int) -> List[Tuple[int, int]]:
+        a_positions: Dict[int, int] = {}
+        for i in range(alo, ahi):
+            a_positions[a[i]] = -1 if a[i] in a_positions else i
+        b_positions: Dict[int, int] = {}
+        for j in range(blo, bhi):
+            if a_positions.get(b[j], -1) != -1:
+                b_positions[b[j]] = -1 if b[j] in b_positions else j
+
+        pairs = [(a_positions[line], j) for line, j in b_positions.items() if j != -1]
+        pairs.sort()
+        return self.longest_increasing(pairs)
+
+    def longest_increasing(self, pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        # patience sorting over the b positions of pairs already ordered by their a positions
+        tails: List[int] = []
+        tail_indexes: List[int] = []
+        previous = [-1] * len(pairs)
+        for index, (_, j) in enumerate(pairs):
+            low, high = 0, len(tails)
+            while low < high:
+                middle = (low + high) // 2
+                if tails[middle] < j:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low > 0:
+                previous[index] = tail_indexes[low - 1]
+            if low == len(tails):
+                tails.append(j)
+                tail_indexes.append(index)
+            else:
+                tails[low] = j
+                tail_indexes[low] = index
+
+        result = []
+        index = tail_indexes[-1] if tail_indexes else -1
+        while index != -1:
+            result.append(pairs[index])
+            index = previous[index]
+        result.reverse()
+        return result
+
+
+ENGINES: Dict[str, DiffEngine] = {
+    engine.name: engine for engine in (DifflibEngine(), MyersEngine(), PatienceEngine())
+}
+
+DIFF_ENGINE = os.getenv('DIFF_ENGINE', 'patience')
+
+
+def get_engine(name: str | None = None) -> DiffEngine:
+    return ENGINES[name or DIFF_ENGINE]
+
+
+def group_opcodes(codes: List[Opcode], n: int = 3) -> Iterator[List[Opcode]]:
+    # same grouping as difflib.SequenceMatcher.get_grouped_opcodes
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f'{beginning}'
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+
+def unified_diff(a: Sequence[str], b: Sequence[str], fromfile: str = '', tofile: str = '', n: int = 3,
+                 lineterm: str = '\n', engine: DiffEngine | None = None) -> Iterator[str]:
+    """Drop-in replacement of difflib.unified_diff producing the same format with a pluggable engine."""
+    engine = engine if engine is not None else get_engine()
+    started = False
+    for group in group_opcodes(engine.get_opcodes(a, b), n):
+        if not started:
+            started = True
+            yield f'--- {fromfile}{lineterm}'
+            yield f'+++ {tofile}{lineterm}'
+
+        first, last = group[0], group[-1]
+        yield f'@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@{lineterm}'
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in {'replace', 'delete'}:
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in {'replace', 'insert'}:
+                for line in b[j1:j2]:
+                    yield '+' + line
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from domain.diff import Patch
+
+PATCH_CACHE_BYTES = int(os.getenv('PATCH_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+
+class PatchCache:
+    """Process-wide LRU of parsed patches keyed by the blake2b digest of their text and bounded by the UTF-8 sizes of the texts.
+
+    Cached patches are shared between threads and frozen, a caller which changes one parses its text again.
+    """
+
+    def __init__(self, max_bytes: int = PATCH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._patches: OrderedDict[bytes, Tuple[Patch, int]] = OrderedDict()  # key: (patch, size in bytes)
+        self.lock = threading.Lock()
+
+    def parse(self, text: List[str] | str | memoryview | bytes) -> Patch:
+        if isinstance(text, (memoryview, bytes, bytearray)):
+            text = str(text, 'utf-8')
+        elif not isinstance(text, str):
+            text = ''.join(text)
+        encoded = text.encode('utf-8', 'surrogatepass')
+        key = hashlib.blake2b(encoded, digest_size=16).digest()
+        size = len(encoded)
+
+        with self.lock:
+            cached = self._patches.get(key)
+            if cached is not None:
+                self._patches.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        patch = Patch(text).freeze()
+        if size > self.max_bytes:
+            return patch
+        with self.lock:
+            if key not in self._patches:
+                self._patches[key] = (patch, size)
+                self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._patches.popitem(last=False)
+                self.size -= evicted_size
+        return patch
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self.size, 'patches': len(self._patches)}
+
+    def clear(self):
+        with self.lock:
+            self._patches = OrderedDict()
+            self.size = 0
+
+
+patch_cache = PatchCache()
+
+
+def parse_patch(text: List[str] | str | memoryview | bytes) -> Patch:
+    return patch_cache.parse(text)
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import zstandard
+
+PATCH_ZSTD_LEVEL = int(os.getenv('PATCH_ZSTD_LEVEL', '9'))
+PATCH_DICT_SIZE = int(os.getenv('PATCH_DICT_SIZE', str(112 * 1024)))
+PATCH_DICT_SAMPLES = int(os.getenv('PATCH_DICT_SAMPLES', '1000'))
+# longer texts are cut to this size before they are kept as dictionary samples
+PATCH_DICT_SAMPLE_BYTES = 64 * 1024
+
+
+def patch_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+class PatchCodec:
+    """zstd compression of patch texts with the latest trained dictionary.
+
+    Until a dictionary exists, texts are compressed without one and kept as samples. When `samples` of them are
+    collected a dictionary is trained on them and handed to `save_dictionary`, which stores it and returns its id.
+    Every blob keeps the id of the dictionary it was compressed with, dictionaries unknown to this process are read
+    by `load_dictionary`, which is also asked for the latest one (id None) on the first use.
+    """
+
+    def __init__(self, level: int = PATCH_ZSTD_LEVEL, dict_size: int = PATCH_DICT_SIZE,
+                 samples: int = PATCH_DICT_SAMPLES):
+        self.level = level
+        self.dict_size = dict_size
+        self.sample_count = samples
+        self.samples: List[bytes] = []
+        self.dictionaries: Dict[int, zstandard.ZstdCompressionDict] = {}
+        self.current_id: int | None = None
+        self.initialized = False
+        self.load_dictionary: Callable[[int | None], Tuple[int, bytes] | None] | None = None
+        self.save_dictionary: Callable[[bytes], int] | None = None
+        self.lock = threading.Lock()
+
+    def compress(self, text: str) -> Tuple[str, int | None, int, bytes]:
+        """(hash, dictionary id, size, compressed data) of the text."""
+        raw = text.encode('utf-8', 'surrogatepass')
+        with self.lock:
+            if not self.initialized:
+                self.initialized = True
+                latest = self.load_dictionary(None) if self.load_dictionary is not None else None
+                if latest is not None:
+                    self.add_dictionary(*latest)
+            dictionary_id = self.current_id
+            if dictionary_id is None and self.save_dictionary is not None:
+                self.samples.append(raw[:PATCH_DICT_SAMPLE_BYTES])
+                if len(self.samples) >= self.sample_count:
+                    data = self.train(self.samples)
+                    self.samples = []
+                    if data is not None:
+                        self.add_dictionary(self.save_dictionary(data), data)
+            dictionary = self.dictionaries.get(dictionary_id) if dictionary_id is not None else None
+
+        if dictionary is None:
+            compressor = zstandard.ZstdCompressor(level=self.level)
+        else:
+            compressor = zstandard.ZstdCompressor(dict_data=dictionary)
+        return patch_hash(raw), dictionary_id, len(raw), compressor.compress(raw)
+
+    def decompress(self, dictionary_id: int | None, data: bytes) -> str:
+        if dictionary_id is None:
+            return zstandard.ZstdDecompressor().decompress(data).decode('utf-8', 'surrogatepass')
+        with self.lock:
+            dictionary = self.dictionaries.get(dictionary_id)
+            if dictionary is None:
+                loaded = self.load_dictionary(dictionary_id)
+                if loaded is None:
+                    raise ValueError(f'patch dictionary {dictionary_id} is not found')
+                dictionary = self.add_dictionary(*loaded, current=False)
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data).decode('utf-8', 'surrogatepass')
+
+    def train(self, samples: List[bytes]) -> bytes | None:
+        try:
+            return zstandard.train_dictionary(self.dict_size, samples, level=self.level).as_bytes()
+        except zstandard.ZstdError as e:
+            print(f'patch dictionary is not trained on {len(samples)} samples: {e}')
+            return None
+
+    def add_dictionary(self, dictionary_id: int, data: bytes, current: bool = True) -> zstandard.ZstdCompressionDict:
+        dictionary = zstandard.ZstdCompressionDict(data)
+        dictionary.precompute_compress(level=self.level)
+        self.dictionaries[dictionary_id] = dictionary
+        if current and (self.current_id is None or dictionary_id > self.current_id):
+            self.current_id = dictionary_id
+        self.initialized = True
+        return dictionary
+
+
+patch_codec = PatchCodec()
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Tuple
+
+from domain.diff import Patch
+from domain.patch_codec import patch_codec
+
+# the log of a batch is compacted into a new base snapshot after this many deltas,
+# or earlier once its deltas take more space than the base
+SNAPSHOT_MAX_DELTAS = int(os.getenv('SNAPSHOT_MAX_DELTAS', '100'))
+
+
+@dataclass
+class PatchState:
+    """Latest working tree patch of a batch split by files, as rebuilt from the snapshot log up to `last_row_id`."""
+    batch_id: int
+    last_row_id: int = 0
+    files: Dict[str, str] = field(default_factory=lambda: {})  # file name: text of its section, in patch order
+    deltas: int = 0
+    delta_bytes: int = 0
+    base_bytes: int = 0
+
+    def to_string(self) -> str:
+        return ''.join(self.files.values())
+
+
+def split_patch(text: str | None) -> Dict[str, str]:
+    if text is None or text == '':
+        return {}
+    files = Patch(text).get_file_texts()
+    if ''.join(files.values()) != text:
+        # text outside of file sections can not be rebuilt from them, such a patch is kept as a whole
+        return {'': text}
+    return files
+
+
+def make_delta(previous: Dict[str, str], current: Dict[str, str]) -> dict | None:
+    """Per file replace operations turning `previous` into `current`, a None text removes the file.
+
+    The file order is only stored when applying the operations would not reproduce it. None means no changes.
+    """
+    files = {name: text for name, text in current.items() if previous.get(name) != text}
+    files.update({name: None for name in previous if name not in current})
+    order = [name for name in previous if name in current] + [name for name in current if name not in previous]
+    if len(files) == 0 and order == list(current):
+        return None
+    delta = {'files': files}
+    if order != list(current):
+        delta['order'] = list(current)
+    return delta
+
+
+def apply_delta(files: Dict[str, str], delta: dict) -> Dict[str, str]:
+    result = dict(files)
+    for name, text in delta['files'].items():
+        if text is None:
+            result.pop(name, None)
+        else:
+            result[name] = text
+    if 'order' in delta:
+        result = {name: result[name] for name in delta['order']}
+    return result
+
+
+def encode_snapshot(snapshot: dict) -> Tuple[int | None, int, bytes]:
+    """(dictionary id, size, data) of a base snapshot or delta."""
+    _, dictionary_id, size, data = patch_codec.compress(json.dumps(snapshot))
+    return dictionary_id, size, data
+
+
+def decode_snapshot(dictionary_id: int | None, data: bytes) -> dict:
+    return json.loads(patch_codec.decompress(dictionary_id, data))
+
+
+def rebuild_state(batch_id: int, rows: Iterable) -> PatchState:
+    """State of the batch from its latest base snapshot row followed by the delta rows, in id order."""
+    state = PatchState(batch_id=batch_id)
+    for row in rows:
+        snapshot = decode_snapshot(row.dictionary_id, row.data)
+        if row.is_base:
+            state = PatchState(batch_id=batch_id, files=apply_delta({}, snapshot), base_bytes=len(row.data))
+        else:
+            state.files = apply_delta(state.files, snapshot)
+            state.deltas += 1
+            state.delta_bytes += len(row.data)
+        state.last_row_id = row.id
+    return state
+
+
+def next_snapshot(state: PatchState, files: Dict[str, str]) -> Tuple[bool, dict] | None:
+    """(is base, snapshot) to append to the log of the state for the new files, None if nothing changed."""
+    delta = make_delta(state.files, files)
+    if delta is None:
+        return None
+    if state.last_row_id == 0 or state.deltas + 1 >= SNAPSHOT_MAX_DELTAS or state.delta_bytes > state.base_bytes:
+        return True, {'files': files}
+    return False, delta
+
+
+def append_snapshot(state: PatchState, row_id: int, is_base: bool, snapshot: dict, data: bytes) -> PatchState:
+    if is_base:
+        return PatchState(batch_id=state.batch_id, last_row_id=row_id, files=apply_delta({}, snapshot),
+                          base_bytes=len(data))
+    return PatchState(batch_id=state.batch_id, last_row_id=row_id, files=apply_delta(state.files, snapshot),
+                      deltas=state.deltas + 1, delta_bytes=state.delta_bytes + len(data), base_bytes=state.base_bytes)
+
+
+class PatchStateCache:
+    """Latest patch state of every project, valid while the last snapshot row of its batch is the cached one."""
+
+    def __init__(self):
+        self.states: Dict[int, PatchState] = {}  # project id: state
+        self.lock = threading.Lock()
+
+    def get(self, project_id: int, batch_id: int, last_row_id: int) -> PatchState | None:
+        with self.lock:
+            state = self.states.get(project_id)
+        if state is None or state.batch_id != batch_id or state.last_row_id != last_row_id:
+            return None
+        return state
+
+    def put(self, project_id: int, state: PatchState):
+        with self.lock:
+            self.states[project_id] = state
+
+
+patch_states = PatchStateCache()
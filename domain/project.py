@@ -1,15 +1,23 @@
 import datetime
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import List
 
 import git
 
 from models import Project
 
 
+@dataclass(frozen=True)
+class ProjectInfo:
+    id: int
+    name: str
+    settings: dict
+
+
 class ProjectContext:
     def __init__(self, project: Project):
-        self.project = project
+        # a detached copy, so that worker threads never touch the ORM object of another thread's session
+        self.project = ProjectInfo(id=project.id, name=project.name, settings=project.settings)
         self.settings = project.settings
         self.repo_path = project.settings["repo_path"]
         self.emails = project.settings.get("emails", [])
@@ -18,6 +26,7 @@ class ProjectContext:
         self.repo = git.Repo(self.repo_path)
         self.last_diff = None
         self.current_diff = None
+        self.tree_index = None
         self.current_branch = self.repo.active_branch.name
         self.current_commit = self.repo.head.commit.hexsha
 
@@ -30,4 +39,4 @@ class ProjectCommit:
     description: str
     author: str
     diff: str = field(default_factory=lambda: "")
-    parents: Dict[str, 'ProjectCommit'] = field(default_factory=lambda: {})  # commit_hash: commit
+    parent_hashes: List[str] = field(default_factory=lambda: [])
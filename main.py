@@ -1,7 +1,7 @@
-from service.runner import Runner
-
-
 def main():
+    # imported here, worker processes import this module again and must not load the app with its database engine
+    from service.runner import Runner
+
     runner = Runner()
     runner.run_all()
 
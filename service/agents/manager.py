@@ -1,7 +1,7 @@
 import json
 
 from api.openai.assistant import ChatGPTAssistant
-from domain.common_db import update_openai_session, close_openai_session
+from domain.async_common_db import update_openai_session, close_openai_session
 from service.agents.commons import DialogueMood
 
 
@@ -43,7 +43,7 @@ class ManagerDialogue:
             response = await self.assistant.message(self.session.session_id, "user",
                                                     self._generate_user_prompt(message_text))
             response_text = self._parse_response(message_text, response, affects_mood)
-            update_openai_session(self.session.session_id)
+            await update_openai_session(self.session.session_id)
             if self.is_debug:
                 response_text = f'{response_text}\n\n{response}\n\nMood:\n```{self.mood.__str__()}```'
             return response_text
@@ -51,7 +51,7 @@ class ManagerDialogue:
             response = await self.assistant.message(self.session.session_id, "user",
                                                     self._generate_farewell_prompt())
             response_text = self._parse_response(message_text, response, affects_mood)
-            close_openai_session(self.session.session_id)
+            await close_openai_session(self.session.session_id)
             return response_text
 
     async def _set_mood(self):
@@ -8,10 +8,12 @@ from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QSystemTrayIcon, QMenu, QAction, QDialog, QLabel, QVBoxLayout
 from qasync import asyncSlot
 
-from api.code_watch.diff_watcher import DiffWatcher
+from api.code_watch.diff_watcher import DiffWatcher, DIFF_WATCH_MODE
+from api.code_watch.event_watcher import DiffEventWatcher
 from api.commit_watch.commit_watcher import CommitWatcher
+from api.git_workers.pool import worker_pool
+from api.metrics.backfill import MetricsBackfill
 from api.openai import client
-from domain.common_db import update_missing_metrics
 from service import worklogs
 from service.worklogs import get_daily_metrics_as_tables, save_worklogs_from_db
 
@@ -19,7 +21,9 @@ from service.worklogs import get_daily_metrics_as_tables, save_worklogs_from_db
 class KDEAssistant:
     def __init__(self, app):
         self.diff_watchers = DiffWatcher()
+        self.diff_event_watcher = DiffEventWatcher(self.diff_watchers)
         self.commit_watcher = CommitWatcher()
+        self.metrics_backfill = MetricsBackfill()
         self.openai = client.OpenAI()
         self.current_tasks = []
         self.last_worklogs = {}
@@ -57,13 +61,17 @@ class KDEAssistant:
         menu.addAction(daily_job_action)
         menu.addAction(exit_action)
 
+        asyncio.ensure_future(worker_pool.run_reaper())
+        if DIFF_WATCH_MODE == 'events':
+            self.diff_event_watcher.start()
+
         await self.process_everything()
 
         self.timer = QTimer()
         self.timer.timeout.connect(lambda: self.process_everything())
         self.timer.start(60 * 1000)  # Check every 5 seconds
 
-        update_missing_metrics()
+        asyncio.ensure_future(self.metrics_backfill.start())
         self.print_daily_metrics()
         self.tray_icon.show()
 
@@ -72,7 +80,7 @@ class KDEAssistant:
 
     @asyncSlot()
     async def process_commits(self):
-        self.commit_watcher.start_once()
+        await self.commit_watcher.start_once()
 
     @asyncSlot()
     async def process_daily_job(self):
@@ -86,9 +94,12 @@ class KDEAssistant:
 
     @asyncSlot()
     async def process_everything(self):
-        self.diff_watchers.start_once()
+        jobs = []
+        if not self.diff_event_watcher.is_running:
+            jobs.append(self.diff_watchers.start_once())
         if datetime.datetime.now().minute % 5 == 0:
-            self.commit_watcher.start_once()
+            jobs.append(self.commit_watcher.start_once())
+        await asyncio.gather(*jobs)
 
     def print_daily_metrics(self):
         overall, unique = get_daily_metrics_as_tables()
@@ -139,6 +150,11 @@ class KDEAssistant:
 
     @asyncSlot()
     async def exit(self):
+        self.diff_event_watcher.stop()
+        self.metrics_backfill.stop()
+        self.diff_watchers.runner.shutdown()
+        self.commit_watcher.shutdown()
+        worker_pool.close()
         self.app.quit()
 
     async def run(self):
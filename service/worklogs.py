@@ -11,7 +11,7 @@ from api.code_watch.diff_watcher import get_projects
 from api.jira.client import get_tasks_in_statuses, Task
 from api.metrics.batch_metrics import BatchMetricsCollector
 from api.openai.client import OpenAI
-from domain.common_db import save_worklog, mark_batches_as_processed, select_non_saved_worklogs
+from domain.common_db import save_worklogs, mark_batches_as_processed, select_non_saved_worklogs
 from domain.db.batches import Batches
 from domain.worklog import Worklog
 from models import SessionLocal, Project, Batch
@@ -366,8 +366,7 @@ def process_job_unprocessed_batches(max_worklog_length: timedelta = timedelta(ho
             # for batch in batches:
             db_batches.clear_outputs(batch.id)
 
-            for log in project_worklogs:
-                save_worklog(project.id, log)
+            save_worklogs(project.id, project_worklogs)
 
             mark_batches_as_processed([batch])
 
@@ -429,8 +428,7 @@ def process_daily_job(max_worklog_length: timedelta = timedelta(hours=2), simpli
         for batch in batches:
             db_batches.clear_outputs(batch.id)
 
-        for log in project_worklogs:
-            save_worklog(project.id, log)
+        save_worklogs(project.id, project_worklogs)
 
         mark_batches_as_processed(batches)
 